@@ -1,15 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from functools import wraps
-import io
 import os
 import re
 import requests
 import secrets
 import stat
+import tarfile
 import tempfile
-from urllib.parse import urlparse
+import threading
+import time
+from urllib.parse import quote, unquote, urlparse
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET
-import importlib.metadata
 from flask import (
     Blueprint, Flask, Response, jsonify, make_response, redirect,
     request, session, stream_with_context, render_template
@@ -18,8 +21,27 @@ from flask_cors import CORS
 
 import logging
 
-import sentry_sdk
-from sentry_sdk.integrations.flask import FlaskIntegration
+from downloadservice.breaker import CircuitBreaker, CircuitOpen
+from downloadservice.cache import ExpiringCache, SharedExpiringCache
+from downloadservice.compression import compress_response
+from downloadservice.dav import (
+    digests_match, iter_multistatus, parse_digest, strip_basepath
+)
+from downloadservice.index import Indexer, MetadataIndex
+from downloadservice.lanes import Lane, LaneAdmission, LaneScheduler
+from downloadservice.limits import (
+    LimitExceeded, SharedUsageLimiter, Slot, ThrottledStream, UsageLimiter,
+    throttled
+)
+from downloadservice.listing import ListingQuery, entry_type, parse_time_arg
+from downloadservice.probe import StorageProber
+from downloadservice.streaming import (
+    PipelinedReader, ReadAhead, ReadAheadPool, ResumeError, ResumingReader
+)
+from downloadservice.traffic import TrafficCapture, TrafficRecorder
+from downloadservice.upstream import (
+    UpstreamPool, failover_statuses, read_within
+)
 
 
 class CertificateError(Exception):
@@ -28,23 +50,57 @@ class CertificateError(Exception):
         super().__init__(self.message)
 
 
-sentry_sdk.init(
-    dsn='https://452458c2a6630292629364221bff0dee@o4505709665976320' +
-        '.ingest.sentry.io/4505709666762752',
-    integrations=[
-        FlaskIntegration(),
-    ],
+logger = logging.getLogger(__name__)
 
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    # We recommend adjusting this value in production.
-    traces_sample_rate=1.0,
+_sentry_lock = threading.Lock()
+_sentry_initialized = False
 
-    release='downloadservice:' + importlib.metadata.version("downloadservice"),
-    environment=os.environ.get('SENTRY_ENVIRONMENT', 'dev'),
-)
 
-logger = logging.getLogger(__name__)
+def init_sentry():
+    """Initialize Sentry once per process.
+
+    This is done on first use rather than at import, which keeps imports
+    fast and lets each forked worker start its own Sentry transport.
+    """
+    global _sentry_initialized
+    if _sentry_initialized:
+        return
+
+    with _sentry_lock:
+        if _sentry_initialized:
+            return
+
+        import importlib.metadata
+        import sentry_sdk
+        from sentry_sdk.integrations.flask import FlaskIntegration
+
+        sentry_sdk.init(
+            dsn='https://452458c2a6630292629364221bff0dee@o4505709665976320' +
+                '.ingest.sentry.io/4505709666762752',
+            integrations=[
+                FlaskIntegration(),
+            ],
+
+            # Set traces_sample_rate to 1.0 to capture 100%
+            # of transactions for performance monitoring.
+            # We recommend adjusting this value in production.
+            traces_sample_rate=1.0,
+
+            # request bodies are files, never to be read for events
+            max_request_body_size='never',
+
+            release='downloadservice:' + importlib.metadata.version(
+                "downloadservice"),
+            environment=os.environ.get('SENTRY_ENVIRONMENT', 'dev'),
+        )
+        _sentry_initialized = True
+
+
+def capture_exception(e):
+    init_sentry()
+
+    import sentry_sdk
+    sentry_sdk.capture_exception(e)
 
 
 def urljoin_multipart(*args):
@@ -56,14 +112,6 @@ def urljoin_multipart(*args):
     )
 
 
-try:
-    from jupyterhub.services.auth import HubOAuth
-    auth = HubOAuth(
-        api_token=os.environ['JUPYTERHUB_API_TOKEN'], cache_max_age=60)
-except Exception:
-    logger.warning('Auth system not configured')
-    auth = None
-
 bp = Blueprint('downloadservice', __name__,
                template_folder='templates')
 
@@ -83,9 +131,22 @@ def create_app():
     app.config['CTACS_URL'] = os.getenv('CTACS_URL', '')
     app.config['JH_BASE_URL'] = os.getenv('JH_BASE_URL', '').strip('/')
 
+    # comma separated list of equivalent upstream endpoints
     app.config['CTADS_UPSTREAM_ENDPOINT'] = \
         os.getenv('CTADS_UPSTREAM_ENDPOINT',
                   'https://dcache.cta.cscs.ch:2880').strip('/')
+    app.config['CTADS_UPSTREAM_SELECTION'] = \
+        os.getenv('CTADS_UPSTREAM_SELECTION', 'latency')
+    app.config['CTADS_UPSTREAM_MAX_FAILURES'] = \
+        int(os.getenv('CTADS_UPSTREAM_MAX_FAILURES', '3'))
+    app.config['CTADS_UPSTREAM_RETRY_AFTER'] = \
+        int(os.getenv('CTADS_UPSTREAM_RETRY_AFTER', '30'))
+    app.config['CTADS_UPSTREAM_LATENCY_TOLERANCE'] = \
+        float(os.getenv('CTADS_UPSTREAM_LATENCY_TOLERANCE', '0.25'))
+    # seconds between background checks of each endpoint, when there are
+    # several; 0 disables them
+    app.config['CTADS_UPSTREAM_PROBE_INTERVAL'] = \
+        int(os.getenv('CTADS_UPSTREAM_PROBE_INTERVAL', '10'))
     app.config['CTADS_UPSTREAM_BASEPATH'] = \
         os.getenv('CTADS_UPSTREAM_BASEPATH', 'pnfs/cta.cscs.ch').strip('/')
     app.config['CTADS_UPSTREAM_BASEFOLDER'] = \
@@ -100,18 +161,262 @@ def create_app():
     app.config['CTADS_DISABLE_ALL_AUTH'] = \
         os.getenv('CTADS_DISABLE_ALL_AUTH', 'False') == 'True'
 
+    # timeouts in seconds of certificate requests to CTACS, and of metadata
+    # requests and file transfers to the storage; a total of 0 is unlimited
+    for operation, connect, read, total in [('CERTIFICATE', 5, 30, 60),
+                                            ('METADATA', 10, 60, 300),
+                                            ('TRANSFER', 10, 60, 0)]:
+        for kind, default in [('CONNECT', connect), ('READ', read),
+                              ('TOTAL', total)]:
+            name = f'CTADS_{operation}_{kind}_TIMEOUT'
+            app.config[name] = float(os.getenv(name, str(default)))
+
+    # circuit breakers of CTACS and of the storage: consecutive failures
+    # opening the circuit, 0 disables them, and seconds until it is probed
+    app.config['CTADS_CIRCUIT_BREAKER_THRESHOLD'] = \
+        int(os.getenv('CTADS_CIRCUIT_BREAKER_THRESHOLD', '5'))
+    app.config['CTADS_CIRCUIT_BREAKER_RESET_TIMEOUT'] = \
+        int(os.getenv('CTADS_CIRCUIT_BREAKER_RESET_TIMEOUT', '30'))
+
+    # per user and per cert key limits of /fetch, /upload and /webdav
+    # transfers: concurrent streams and bandwidth in bytes/s, 0 is unlimited
+    app.config['CTADS_USER_MAX_STREAMS'] = \
+        int(os.getenv('CTADS_USER_MAX_STREAMS', '8'))
+    app.config['CTADS_USER_BANDWIDTH'] = \
+        int(os.getenv('CTADS_USER_BANDWIDTH', '0'))
+    app.config['CTADS_CERT_KEY_MAX_STREAMS'] = \
+        int(os.getenv('CTADS_CERT_KEY_MAX_STREAMS', '0'))
+    app.config['CTADS_CERT_KEY_BANDWIDTH'] = \
+        int(os.getenv('CTADS_CERT_KEY_BANDWIDTH', '0'))
+    app.config['CTADS_LIMIT_RETRY_AFTER'] = \
+        int(os.getenv('CTADS_LIMIT_RETRY_AFTER', '5'))
+
+    # background checks of the upstream for /storage-status
+    app.config['CTADS_STORAGE_STATUS_INTERVAL'] = \
+        int(os.getenv('CTADS_STORAGE_STATUS_INTERVAL', '30'))
+    app.config['CTADS_STORAGE_STATUS_TIMEOUT'] = \
+        int(os.getenv('CTADS_STORAGE_STATUS_TIMEOUT', '10'))
+    app.config['CTADS_STORAGE_STATUS_CREDENTIAL_MAX_AGE'] = \
+        int(os.getenv('CTADS_STORAGE_STATUS_CREDENTIAL_MAX_AGE', '3600'))
+    # only one of several worker processes sharing CTADS_SHARED_CACHE_PATH
+    # probes, the others answer from its shared result
+    app.config['CTADS_STORAGE_STATUS_PROBE'] = True
+
+    # number of chunks buffered between the client reader and the upstream
+    # writer of an upload
+    app.config['CTADS_UPLOAD_PIPELINE_DEPTH'] = \
+        int(os.getenv('CTADS_UPLOAD_PIPELINE_DEPTH', '4'))
+
+    # resuming of interrupted /fetch transfers
+    app.config['CTADS_FETCH_READ_TIMEOUT'] = \
+        float(os.getenv('CTADS_FETCH_READ_TIMEOUT', '60'))
+    app.config['CTADS_FETCH_MAX_RESUMES'] = \
+        int(os.getenv('CTADS_FETCH_MAX_RESUMES', '3'))
+
+    # read-ahead of /fetch transfers: bytes buffered in memory per transfer
+    # and in total, and optionally on disk per transfer; 0 disables it
+    app.config['CTADS_FETCH_READ_AHEAD'] = \
+        int(os.getenv('CTADS_FETCH_READ_AHEAD', str(32 * 1024**2)))
+    app.config['CTADS_FETCH_READ_AHEAD_TOTAL'] = \
+        int(os.getenv('CTADS_FETCH_READ_AHEAD_TOTAL', str(512 * 1024**2)))
+    app.config['CTADS_FETCH_SPILL_DIR'] = \
+        os.getenv('CTADS_FETCH_SPILL_DIR', '')
+    app.config['CTADS_FETCH_SPILL_SIZE'] = \
+        int(os.getenv('CTADS_FETCH_SPILL_SIZE', str(1024**3)))
+
+    # opt-in /fetch?mode=redirect, sending clients directly to the upstream
+    # with a short-lived macaroon
+    app.config['CTADS_FETCH_REDIRECT'] = \
+        os.getenv('CTADS_FETCH_REDIRECT', 'False') == 'True'
+    app.config['CTADS_FETCH_REDIRECT_VALIDITY'] = \
+        int(os.getenv('CTADS_FETCH_REDIRECT_VALIDITY', '600'))
+
+    # compression of listing responses (JSON, XML)
+    app.config['CTADS_COMPRESSION_ENABLED'] = \
+        os.getenv('CTADS_COMPRESSION_ENABLED', 'True') == 'True'
+    app.config['CTADS_COMPRESSION_MIN_SIZE'] = \
+        int(os.getenv('CTADS_COMPRESSION_MIN_SIZE', '1024'))
+    app.config['CTADS_COMPRESSION_GZIP_LEVEL'] = \
+        int(os.getenv('CTADS_COMPRESSION_GZIP_LEVEL', '6'))
+    app.config['CTADS_COMPRESSION_ZSTD_LEVEL'] = \
+        int(os.getenv('CTADS_COMPRESSION_ZSTD_LEVEL', '3'))
+
+    # bulk /stat requests
+    app.config['CTADS_STAT_MAX_PATHS'] = \
+        int(os.getenv('CTADS_STAT_MAX_PATHS', '1000'))
+    app.config['CTADS_STAT_CONCURRENCY'] = \
+        int(os.getenv('CTADS_STAT_CONCURRENCY', '8'))
+
+    # /upload-tar: concurrent uploads, and size up to which members are
+    # buffered in memory to be uploaded concurrently
+    app.config['CTADS_TAR_CONCURRENCY'] = \
+        int(os.getenv('CTADS_TAR_CONCURRENCY', '8'))
+    app.config['CTADS_TAR_MEMBER_BUFFER_SIZE'] = \
+        int(os.getenv('CTADS_TAR_MEMBER_BUFFER_SIZE', str(16 * 1024**2)))
+
+    # concurrent upstream requests of a recursive DELETE through /webdav
+    app.config['CTADS_DELETE_CONCURRENCY'] = \
+        int(os.getenv('CTADS_DELETE_CONCURRENCY', '8'))
+
+    # SQLite file of caches shared between worker processes, caches are
+    # local to each process when empty
+    app.config['CTADS_SHARED_CACHE_PATH'] = \
+        os.getenv('CTADS_SHARED_CACHE_PATH', '')
+
+    # metadata index used by /search, disabled when no path is set
+    app.config['CTADS_INDEX_PATH'] = os.getenv('CTADS_INDEX_PATH', '')
+    app.config['CTADS_INDEX_BASEFOLDERS'] = os.getenv(
+        'CTADS_INDEX_BASEFOLDERS', 'lst').split(',')
+    app.config['CTADS_INDEX_INTERVAL'] = \
+        int(os.getenv('CTADS_INDEX_INTERVAL', '3600'))
+    app.config['CTADS_INDEX_CONCURRENCY'] = \
+        int(os.getenv('CTADS_INDEX_CONCURRENCY', '8'))
+    # only one of several worker processes crawls
+    app.config['CTADS_INDEX_CRAWL'] = True
+
+    # scheduling lanes of interactive metadata requests and of bulk
+    # transfers: running and queued requests per worker process, 0 is
+    # unlimited; interactive requests also take free bulk slots, and first
+    app.config['CTADS_LANES'] = os.getenv('CTADS_LANES', 'True') == 'True'
+    app.config['CTADS_INTERACTIVE_CAPACITY'] = \
+        int(os.getenv('CTADS_INTERACTIVE_CAPACITY', '8'))
+    app.config['CTADS_INTERACTIVE_QUEUE'] = \
+        int(os.getenv('CTADS_INTERACTIVE_QUEUE', '32'))
+    app.config['CTADS_BULK_CAPACITY'] = \
+        int(os.getenv('CTADS_BULK_CAPACITY', '8'))
+    app.config['CTADS_BULK_QUEUE'] = \
+        int(os.getenv('CTADS_BULK_QUEUE', '16'))
+    app.config['CTADS_LANE_QUEUE_TIMEOUT'] = \
+        int(os.getenv('CTADS_LANE_QUEUE_TIMEOUT', '30'))
+
+    # anonymised request records for replay, disabled when no path is set;
+    # names are hashed with the key, by default the flask secret, which
+    # must then be the same for all workers
+    app.config['CTADS_TRAFFIC_CAPTURE_PATH'] = \
+        os.getenv('CTADS_TRAFFIC_CAPTURE_PATH', '')
+    app.config['CTADS_TRAFFIC_CAPTURE_SAMPLE'] = \
+        float(os.getenv('CTADS_TRAFFIC_CAPTURE_SAMPLE', '1'))
+    app.config['CTADS_TRAFFIC_CAPTURE_KEY'] = \
+        os.getenv('CTADS_TRAFFIC_CAPTURE_KEY', '')
+
     return app
 
 
 app = create_app()
 
 
+@app.before_request
+def setup_sentry():
+    init_sentry()
+
+
+_traffic_recorder_lock = threading.Lock()
+
+
+def get_traffic_recorder():
+    """Recorder of anonymised traffic, None when capture is disabled."""
+    with _traffic_recorder_lock:
+        if 'traffic_recorder' not in app.extensions:
+            recorder = None
+            if app.config['CTADS_TRAFFIC_CAPTURE_PATH']:
+                key = app.config['CTADS_TRAFFIC_CAPTURE_KEY'] or \
+                    app.secret_key
+                if isinstance(key, str):
+                    key = key.encode()
+                recorder = TrafficRecorder(
+                    app.config['CTADS_TRAFFIC_CAPTURE_PATH'], key,
+                    app.config['CTADS_TRAFFIC_CAPTURE_SAMPLE'])
+            app.extensions['traffic_recorder'] = recorder
+    return app.extensions['traffic_recorder']
+
+
+_lane_scheduler_lock = threading.Lock()
+
+
+def get_lane_scheduler():
+    """Scheduler of the interactive and bulk lanes, None when disabled."""
+    with _lane_scheduler_lock:
+        if 'lane_scheduler' not in app.extensions:
+            scheduler = None
+            if app.config['CTADS_LANES']:
+                scheduler = LaneScheduler(
+                    [Lane('interactive',
+                          app.config['CTADS_INTERACTIVE_CAPACITY'],
+                          app.config['CTADS_INTERACTIVE_QUEUE'],
+                          borrows=True),
+                     Lane('bulk',
+                          app.config['CTADS_BULK_CAPACITY'],
+                          app.config['CTADS_BULK_QUEUE'])],
+                    app.config['CTADS_LANE_QUEUE_TIMEOUT'],
+                    app.config['CTADS_LIMIT_RETRY_AFTER'])
+            app.extensions['lane_scheduler'] = scheduler
+    return app.extensions['lane_scheduler']
+
+
+# recorded durations include the wait in the lanes
+app.wsgi_app = TrafficCapture(
+    LaneAdmission(app.wsgi_app, get_lane_scheduler, url_prefix),
+    get_traffic_recorder)
+
+
+@app.before_request
+def traffic_route():
+    request.environ['ctads.route'] = request.endpoint
+    request.environ['ctads.path'] = (request.view_args or {}).get('path')
+
+
+_auth_lock = threading.Lock()
+
+
+def get_auth():
+    """JupyterHub OAuth client, created on first use; None when the auth
+    system is not configured."""
+    with _auth_lock:
+        if 'auth' not in app.extensions:
+            try:
+                from jupyterhub.services.auth import HubOAuth
+                app.extensions['auth'] = HubOAuth(
+                    api_token=os.environ['JUPYTERHUB_API_TOKEN'],
+                    cache_max_age=60)
+            except Exception:
+                logger.warning('Auth system not configured')
+                app.extensions['auth'] = None
+        return app.extensions['auth']
+
+
 @app.errorhandler(CertificateError)
 def handle_certificate_error(e):
-    sentry_sdk.capture_exception(e)
+    capture_exception(e)
     return e.message, 400
 
 
+@app.after_request
+def compress(response):
+    if not app.config['CTADS_COMPRESSION_ENABLED'] or request.method == 'HEAD':
+        return response
+    # only listings, never file bodies whatever their mimetype
+    if not (request.endpoint == 'list_dir' or
+            (request.endpoint == 'webdav' and
+             request.method in ['PROPFIND', 'PROPPATCH'])):
+        return response
+    return compress_response(response, request.accept_encodings, app.config)
+
+
+@app.errorhandler(LimitExceeded)
+def handle_limit_exceeded(e):
+    return e.message, 429, {'Retry-After': str(e.retry_after)}
+
+
+@app.errorhandler(CircuitOpen)
+def handle_circuit_open(e):
+    return f'Error: {e.message}', 503, {'Retry-After': str(e.retry_after)}
+
+
+@app.errorhandler(requests.exceptions.Timeout)
+def handle_upstream_timeout(e):
+    return f'Error: upstream timed out: {e}', 504
+
+
 def cert_key_from_path(path):
     logger.info('cert_key_from_path for path=%s', path)
 
@@ -142,6 +447,7 @@ def authenticated(f):
         if app.config['CTADS_DISABLE_ALL_AUTH']:
             return f({'name': 'anonymous', 'admin': True}, *args, **kwargs)
         else:
+            auth = get_auth()
             if auth is None:
                 return 'Unable to use jupyterhub to verify access to this\
                     service. At this time, the downloadservice uses jupyterhub\
@@ -205,13 +511,29 @@ def get_upstream_session(user, certificate_key):
             if isinstance(user, dict):
                 username = user['name']
 
-            r = requests.get(
-                urljoin_multipart(os.environ['CTACS_URL'], '/certificate'),
-                params={
-                    'service-token': service_token,
-                    'user': username,
-                    'certificate_key': certificate_key,
-                })
+            breaker = get_circuit_breakers()['ctacs']
+            breaker.before()
+            timeout, total_timeout = upstream_timeout('certificate')
+            try:
+                r = requests.get(
+                    urljoin_multipart(
+                        os.environ['CTACS_URL'], '/certificate'),
+                    params={
+                        'service-token': service_token,
+                        'user': username,
+                        'certificate_key': certificate_key,
+                    },
+                    timeout=timeout, stream=bool(total_timeout))
+                if total_timeout:
+                    read_within(r, time.monotonic() + total_timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                breaker.failure(e)
+                raise
+            if r.status_code >= 500:
+                breaker.failure(f'status {r.status_code}')
+            else:
+                breaker.success()
 
             if r.status_code != 200:
                 logger.error(
@@ -234,39 +556,352 @@ def get_upstream_session(user, certificate_key):
         yield upstream_session
 
 
+def upstream_request_body(chunk_size, throttle=None):
+    """Body of the current request, ready to be sent upstream.
+
+    Small bodies of known size are read at once, larger or chunked ones are
+    read by a PipelinedReader so that reading from the client overlaps
+    with writing to the upstream. The client Content-Length is kept, so the
+    upstream receives a sized request. Reads are shaped by `throttle(n)`
+    when it is given.
+    """
+    stream = request.stream
+    if throttle is not None:
+        stream = ThrottledStream(stream, throttle)
+
+    length = request.content_length
+    if length is None and not request.environ.get('wsgi.input_terminated'):
+        return b''
+    if length is not None and length <= chunk_size:
+        return stream.read()
+
+    return PipelinedReader(stream, chunk_size,
+                           app.config['CTADS_UPLOAD_PIPELINE_DEPTH'], length)
+
+
+_caches_lock = threading.Lock()
+
+
+def get_cache(name):
+    """Cache `name` of the app, shared between processes when
+    CTADS_SHARED_CACHE_PATH is set."""
+    with _caches_lock:
+        caches = app.extensions.setdefault('caches', {})
+        if name not in caches:
+            if app.config['CTADS_SHARED_CACHE_PATH']:
+                caches[name] = SharedExpiringCache(
+                    app.config['CTADS_SHARED_CACHE_PATH'], name)
+            else:
+                caches[name] = ExpiringCache()
+
+    return caches[name]
+
+
+_limiters_lock = threading.Lock()
+
+
+def get_limiters():
+    """Transfer limiters per user and per cert key, shared between
+    processes when CTADS_SHARED_CACHE_PATH is set."""
+    with _limiters_lock:
+        if 'limiters' not in app.extensions:
+            retry_after = app.config['CTADS_LIMIT_RETRY_AFTER']
+            if app.config['CTADS_SHARED_CACHE_PATH']:
+                def make_limiter(*args):
+                    return SharedUsageLimiter(
+                        app.config['CTADS_SHARED_CACHE_PATH'], *args)
+            else:
+                make_limiter = UsageLimiter
+            app.extensions['limiters'] = [
+                make_limiter('user',
+                             app.config['CTADS_USER_MAX_STREAMS'],
+                             app.config['CTADS_USER_BANDWIDTH'],
+                             retry_after),
+                make_limiter('certificate',
+                             app.config['CTADS_CERT_KEY_MAX_STREAMS'],
+                             app.config['CTADS_CERT_KEY_BANDWIDTH'],
+                             retry_after),
+            ]
+
+    return app.extensions['limiters']
+
+
+def forget_transfers(pid=None):
+    """Drop the transfers counted in the shared limiters for process `pid`,
+    which exited, or for all processes."""
+    if app.config['CTADS_SHARED_CACHE_PATH']:
+        SharedUsageLimiter.forget_process(
+            app.config['CTADS_SHARED_CACHE_PATH'], pid)
+
+
+def acquire_transfer_slot(user, cert_key):
+    """Admit a transfer for the user and cert key, or raise
+    LimitExceeded."""
+    username = user['name'] if isinstance(user, dict) else user
+    return Slot(get_limiters(), [username, cert_key])
+
+
+_read_ahead_pool_lock = threading.Lock()
+
+
+def get_read_ahead_pool():
+    with _read_ahead_pool_lock:
+        if 'read_ahead_pool' not in app.extensions:
+            app.extensions['read_ahead_pool'] = ReadAheadPool(
+                app.config['CTADS_FETCH_READ_AHEAD_TOTAL'])
+    return app.extensions['read_ahead_pool']
+
+
+def upstream_timeout(operation):
+    """(connect, read) and total timeouts of 'certificate', 'metadata' or
+    'transfer' requests."""
+    name = f'CTADS_{operation.upper()}'
+    return ((app.config[f'{name}_CONNECT_TIMEOUT'],
+             app.config[f'{name}_READ_TIMEOUT']),
+            app.config[f'{name}_TOTAL_TIMEOUT'])
+
+
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breakers():
+    with _circuit_breakers_lock:
+        if 'circuit_breakers' not in app.extensions:
+            app.extensions['circuit_breakers'] = {
+                name: CircuitBreaker(
+                    name,
+                    app.config['CTADS_CIRCUIT_BREAKER_THRESHOLD'],
+                    app.config['CTADS_CIRCUIT_BREAKER_RESET_TIMEOUT'])
+                for name in ['ctacs', 'storage']
+            }
+    return app.extensions['circuit_breakers']
+
+
+_upstream_pool_lock = threading.Lock()
+
+
+def get_upstream_pool():
+    with _upstream_pool_lock:
+        if 'upstream_pool' not in app.extensions:
+            pool = UpstreamPool(
+                app.config['CTADS_UPSTREAM_ENDPOINT'].split(','),
+                selection=app.config['CTADS_UPSTREAM_SELECTION'],
+                max_failures=app.config['CTADS_UPSTREAM_MAX_FAILURES'],
+                retry_after=app.config['CTADS_UPSTREAM_RETRY_AFTER'],
+                latency_tolerance=app.config[
+                    'CTADS_UPSTREAM_LATENCY_TOLERANCE'])
+            if len(pool.endpoints) > 1 and \
+                    app.config['CTADS_UPSTREAM_PROBE_INTERVAL'] > 0:
+                pool.start_probes(
+                    lambda: get_upstream_session('shared::certificate',
+                                                 cert_key_from_path(None)),
+                    urljoin_multipart(
+                        app.config['CTADS_UPSTREAM_BASEPATH'],
+                        app.config['CTADS_UPSTREAM_HEALTH_BASEFOLDER']),
+                    app.config['CTADS_UPSTREAM_PROBE_INTERVAL'],
+                    timeout=app.config['CTADS_STORAGE_STATUS_TIMEOUT'],
+                    credential_max_age=app.config[
+                        'CTADS_STORAGE_STATUS_CREDENTIAL_MAX_AGE'])
+            app.extensions['upstream_pool'] = pool
+
+    return app.extensions['upstream_pool']
+
+
+def upstream_request(upstream_session, method, path, destination=None,
+                     operation=None, **kwargs):
+    """Send a request for `path`, relative to the upstream base path, to
+    one of the upstream endpoints.
+
+    Without an explicit timeout, the timeouts of `operation` apply,
+    'transfer' for GET and PUT and 'metadata' otherwise. Fails fast with
+    CircuitOpen while the storage is unavailable.
+    """
+    if destination is not None:
+        destination = urljoin_multipart(
+            app.config['CTADS_UPSTREAM_BASEPATH'], destination)
+    if 'timeout' not in kwargs:
+        operation = operation or \
+            ('transfer' if method in ['GET', 'PUT'] else 'metadata')
+        kwargs['timeout'], kwargs['total_timeout'] = \
+            upstream_timeout(operation)
+
+    breaker = get_circuit_breakers()['storage']
+    breaker.before()
+    try:
+        r = get_upstream_pool().request(
+            upstream_session, method,
+            urljoin_multipart(app.config['CTADS_UPSTREAM_BASEPATH'], path),
+            destination=destination, **kwargs)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as e:
+        breaker.failure(e)
+        raise
+    if r.status_code in failover_statuses:
+        breaker.failure(f'status {r.status_code}')
+    else:
+        breaker.success()
+    return r
+
+
+_metadata_index_lock = threading.Lock()
+
+
+def get_metadata_index():
+    """Metadata index of the app, created on first use.
+
+    The background indexer is started with the index, unless
+    CTADS_INDEX_INTERVAL is 0. Returns None if CTADS_INDEX_PATH is not set.
+    """
+    if not app.config['CTADS_INDEX_PATH']:
+        return None
+
+    with _metadata_index_lock:
+        if 'metadata_index' not in app.extensions:
+            index = MetadataIndex(
+                app.config['CTADS_INDEX_PATH'], cert_key_from_path)
+            indexer = Indexer(
+                index,
+                upstream_request,
+                app.config['CTADS_UPSTREAM_BASEPATH'],
+                app.config['CTADS_INDEX_BASEFOLDERS'],
+                lambda folder: get_upstream_session(
+                    'shared::certificate', cert_key_from_path(folder)),
+                concurrency=app.config['CTADS_INDEX_CONCURRENCY'],
+                interval=app.config['CTADS_INDEX_INTERVAL'])
+            if app.config['CTADS_INDEX_CRAWL'] and \
+                    app.config['CTADS_INDEX_INTERVAL'] > 0:
+                indexer.start()
+            app.extensions['metadata_index'] = index
+            app.extensions['metadata_indexer'] = indexer
+
+    return app.extensions['metadata_index']
+
+
+def start_background_tasks():
+    init_sentry()
+    get_metadata_index()
+    if app.config['CTADS_STORAGE_STATUS_PROBE']:
+        get_storage_prober()
+
+
+user_cert_keys_max_age = 60
+
+
+def user_cert_keys(user):
+    """Cert keys for which the user can obtain a certificate."""
+    keys = set(app.config['CTACS_ALLOWED_CERT_KEYS'] +
+               [cert_key_from_path(None)])
+    if app.config['CTADS_DISABLE_ALL_AUTH']:
+        return sorted(keys)
+
+    username = user['name'] if isinstance(user, dict) else user
+    cached = get_cache('user_cert_keys').get(username)
+    if cached is not None:
+        return cached
+
+    allowed = []
+    for key in sorted(keys):
+        try:
+            with get_upstream_session(user, key):
+                allowed.append(key)
+        except CertificateError:
+            logger.info('user %s has no certificate for %s', username, key)
+
+    get_cache('user_cert_keys').set(
+        username, allowed, user_cert_keys_max_age)
+    return allowed
+
+
 @app.route(url_prefix + '/health')
 def health():
     # Different from /dcache-status as the service might be up without dcache
     return 'OK - DownloadService is up and running', 200
 
 
+def probe_storage(upstream_session):
+    r = upstream_request(
+        upstream_session, 'PROPFIND',
+        app.config['CTADS_UPSTREAM_HEALTH_BASEFOLDER'],
+        headers={'Depth': '1'},
+        timeout=app.config['CTADS_STORAGE_STATUS_TIMEOUT'])
+    if r.status_code in [200, 207]:
+        return True, 'OK - DCache is accessible using configured ' + \
+            'shared certificate'
+    else:
+        return False, 'Unhealthy! - DCache is not accessible using ' + \
+            'configured shared certificate'
+
+
+_storage_prober_lock = threading.Lock()
+
+
+def get_storage_prober():
+    """Storage prober of the app, created and started on first use."""
+    with _storage_prober_lock:
+        if 'storage_prober' not in app.extensions:
+            # Find another way to check without any token
+            prober = StorageProber(
+                lambda: get_upstream_session('shared::certificate',
+                                             cert_key_from_path(None)),
+                probe_storage,
+                interval=app.config['CTADS_STORAGE_STATUS_INTERVAL'],
+                credential_max_age=app.config[
+                    'CTADS_STORAGE_STATUS_CREDENTIAL_MAX_AGE'],
+                on_status=publish_storage_status
+                if app.config['CTADS_SHARED_CACHE_PATH'] else None)
+            if app.config['CTADS_STORAGE_STATUS_INTERVAL'] > 0:
+                prober.start()
+            app.extensions['storage_prober'] = prober
+
+    return app.extensions['storage_prober']
+
+
+def publish_storage_status(status):
+    # as stale as the status of the prober once expired
+    get_cache('storage_status').set(
+        'status', status, 3 * app.config['CTADS_STORAGE_STATUS_INTERVAL'])
+
+
 @app.route(url_prefix + '/storage-status')
 def storage_status():
-    url = urljoin_multipart(
-        app.config['CTADS_UPSTREAM_ENDPOINT'],
-        app.config['CTADS_UPSTREAM_BASEPATH'],
-        app.config['CTADS_UPSTREAM_HEALTH_BASEFOLDER']
-    )
+    if app.config['CTADS_STORAGE_STATUS_PROBE'] or \
+            app.config['CTADS_STORAGE_STATUS_INTERVAL'] <= 0:
+        status = get_storage_prober().status()
+    else:
+        status = get_cache('storage_status').get('status') or dict(
+            healthy=False, message='No recent result of the storage probe',
+            checked_at=None, last_success=None, history=[])
+    if status['healthy'] is None:
+        return jsonify(status), 503
+    return jsonify(status), 200 if status['healthy'] else 500
+
+
+@app.route(url_prefix + '/upstream-status')
+def upstream_status():
+    return jsonify(dict(
+        get_upstream_pool().stats(),
+        read_ahead=get_read_ahead_pool().stats(),
+        circuit_breakers={name: breaker.stats() for name, breaker
+                          in get_circuit_breakers().items()})), 200
+
+
+@app.route(url_prefix + '/lane-status')
+def lane_status():
+    scheduler = get_lane_scheduler()
+    return jsonify(scheduler.stats() if scheduler else {}), 200
+
+
+@app.route(url_prefix + '/usage')
+@authenticated
+def usage(user):
+    """Current transfers and transferred bytes, of all users for admins."""
+    users, cert_keys = [limiter.stats() for limiter in get_limiters()]
+    if not user.get('admin', False):
+        users = {user['name']: users.get(
+            user['name'], dict(active=0, transferred=0))}
+        cert_keys = None
 
-    # Find another way to check without any token
-    cert_key = cert_key_from_path(None)
-    with get_upstream_session('shared::certificate',
-                              cert_key) as upstream_session:
-        try:
-            r = upstream_session.request('PROPFIND', url, headers={
-                                         'Depth': '1'}, timeout=10)
-            if r.status_code in [200, 207]:
-                return 'OK - DCache is accessible using configured ' + \
-                    'shared certificate', 200
-            else:
-                logger.error('service is unhealthy')
-                return 'Unhealthy! - DCache is not accessible using ' + \
-                    'configured shared certificate', 500
-        except requests.exceptions.ReadTimeout as e:
-            logger.error('service is unhealthy: %s', e)
-            sentry_sdk.capture_exception(e)
-            return 'Unhealthy! - DCache is not accessible using ' + \
-                'configured shared certificate', 500
+    return jsonify(dict(users=users, certificates=cert_keys)), 200
 
 
 @app.route(url_prefix + '/list', methods=['GET', 'POST'],
@@ -274,16 +909,15 @@ def storage_status():
 @app.route(url_prefix + '/list/<path:path>', methods=['GET', 'POST'])
 @authenticated
 def list_dir(user, path):
-    upstream_url = urljoin_multipart(
-        app.config['CTADS_UPSTREAM_ENDPOINT'],
-        app.config['CTADS_UPSTREAM_BASEPATH'],
-        (path or '')
-    )
+    try:
+        query = ListingQuery.from_args(request.args)
+    except ValueError as e:
+        return f'Error: invalid list argument: {e}', 400
 
     cert_key = cert_key_from_path(path)
     with get_upstream_session(user, cert_key) as upstream_session:
-        r = upstream_session.request(
-            'PROPFIND', upstream_url, headers={'Depth': '1'})
+        r = upstream_request(
+            upstream_session, 'PROPFIND', path, headers={'Depth': '1'})
 
         if r.status_code not in [200, 207]:
             return f'Error: {r.status_code} {r.content.decode()}', \
@@ -291,51 +925,165 @@ def list_dir(user, path):
 
         logger.debug('response: %s', r.content.decode())
 
+        up = urlparse(request.url)
+        url_base = '/'.join([
+            app.config['JH_BASE_URL'] or up.scheme + '://' + up.netloc,
+            re.sub(path, '', up.path).strip('/')
+        ])
+
+        entries = []
+
         try:
-            tree = ET.parse(io.BytesIO(r.content))
-            root = tree.getroot()
+            for href, size, mtime in iter_multistatus(r.content):
+                href = strip_basepath(
+                    href, app.config['CTADS_UPSTREAM_BASEPATH'])
+                if not query.match(href, size, mtime):
+                    continue
+
+                entry = dict(href=href, url=url_base + '/' + href)
+                if size is not None:
+                    entry['size'] = size
+                if mtime is not None:
+                    entry['mtime'] = mtime
+                entry['type'] = entry_type(href)
+
+                entries.append(entry)
         except ET.ParseError as e:
             logger.error('Error parsing XML %s in %s', e, r.content)
             raise
 
-        logger.info('xml: %s', root)
+        entries = query.sorted(entries)
 
-        entries = []
+        if query.format == 'json':
+            return jsonify([query.project(entry) for entry in entries]), 200
 
-        keymap = dict([
-            ('{DAV:}href', 'href'),
-            ('{DAV:}getcontentlength', 'size'),
-            ('{DAV:}getlastmodified', 'mtime')
-        ])
+        body, mimetype = query.render(entries, url_base + '/')
+        return Response(body, mimetype=mimetype), 200
+        # TODO print useful logs for loki
 
-        for i in root.iter('{DAV:}response'):
-            logger.debug('i: %s', i)
 
-            entry = {}
-            entries.append(entry)
+def stat_path(upstream_session, path, checksums=False):
+    """Metadata of a single upstream path, or the error preventing it."""
+    try:
+        r = upstream_request(
+            upstream_session, 'PROPFIND', path, headers={'Depth': '0'})
+        if r.status_code not in [200, 207]:
+            return dict(path=path, error=f'{r.status_code} {r.reason}')
 
-            for j in i.iter():
-                logger.debug('> j: %s %s', j.tag, j.text)
-                if j.tag in keymap:
-                    entry[keymap[j.tag]] = j.text
+        href, size, mtime = next(iter_multistatus(r.content))
+        href = strip_basepath(href, app.config['CTADS_UPSTREAM_BASEPATH'])
+        entry = dict(path=path, href=href, type=entry_type(href),
+                     size=size, mtime=mtime)
 
-            up = urlparse(request.url)
-            entry['href'] = re.sub(
-                '^/*'+app.config['CTADS_UPSTREAM_BASEPATH']+'/',
-                '', entry['href'])
+        if checksums and entry['type'] == 'file':
+            r = upstream_request(
+                upstream_session, 'HEAD', path,
+                headers={'Want-Digest': 'adler32,md5'})
+            entry['checksums'] = parse_digest(r.headers.get('Digest'))
 
-            entry['url'] = '/'.join([
-                app.config['JH_BASE_URL'] or up.scheme + '://' + up.netloc,
-                re.sub(path, '', up.path).strip('/'), entry['href']
-            ])
+        return entry
+    except (requests.exceptions.RequestException, ET.ParseError,
+            StopIteration) as e:
+        logger.error('Error while getting metadata of %s: %s', path, e)
+        return dict(path=path, error=str(e))
 
-            if entry['href'].endswith('/'):
-                entry['type'] = 'directory'
-            else:
-                entry['type'] = 'file'
 
-        return jsonify(entries), 200
-        # TODO print useful logs for loki
+@app.route(url_prefix + '/stat', methods=['POST'])
+@authenticated
+def bulk_stat(user):
+    body = request.get_json(silent=True) or {}
+    paths = body.get('paths')
+    if not isinstance(paths, list) or \
+            not all(isinstance(path, str) for path in paths):
+        return "Error: expected a JSON body with a list of 'paths'", 400
+    if len(paths) > app.config['CTADS_STAT_MAX_PATHS']:
+        return 'Error: too many paths, at most ' + \
+            f"{app.config['CTADS_STAT_MAX_PATHS']} are allowed", 400
+    checksums = bool(body.get('checksums', False))
+
+    results = [None] * len(paths)
+    groups = {}
+    for i, path in enumerate(paths):
+        if '..' in path:
+            results[i] = dict(path=path, error="path cannot contain '..'")
+        else:
+            groups.setdefault(cert_key_from_path(path), []).append(i)
+
+    concurrency = app.config['CTADS_STAT_CONCURRENCY']
+    for cert_key, indices in groups.items():
+        try:
+            with get_upstream_session(user, cert_key) as upstream_session:
+                adapter = HTTPAdapter(pool_maxsize=concurrency)
+                upstream_session.mount('http://', adapter)
+                upstream_session.mount('https://', adapter)
+
+                with ThreadPoolExecutor(concurrency) as pool:
+                    for i, result in zip(indices, pool.map(
+                            lambda i: stat_path(
+                                upstream_session, paths[i], checksums),
+                            indices)):
+                        results[i] = result
+        except CertificateError as e:
+            for i in indices:
+                results[i] = dict(path=paths[i], error=e.message)
+
+    return jsonify(results), 200
+
+
+@app.route(url_prefix + '/search', methods=['GET', 'POST'])
+@authenticated
+def search(user):
+    index = get_metadata_index()
+    if index is None:
+        return 'Error: metadata index is not enabled', 404
+
+    filters = dict(glob=request.args.get('glob'),
+                   type=request.args.get('type'))
+    try:
+        for name, arg_type in [('size_min', int), ('size_max', int),
+                               ('mtime_min', parse_time_arg),
+                               ('mtime_max', parse_time_arg),
+                               ('limit', int)]:
+            if (value := request.args.get(name)) is not None:
+                filters[name] = arg_type(value)
+    except ValueError as e:
+        return f'Error: invalid search argument: {e}', 400
+
+    entries = index.search(user_cert_keys(user), **filters)
+
+    return jsonify(entries), 200
+
+
+def fetch_redirect(user, path):
+    """Redirect to the upstream, authorized by a path-scoped macaroon.
+
+    Macaroons are requested from the upstream with the user certificate and
+    reused, per user and path, for most of their validity.
+    """
+    username = user['name'] if isinstance(user, dict) else user
+    location = get_cache('fetch_redirect').get((username, path))
+
+    if location is None:
+        validity = app.config['CTADS_FETCH_REDIRECT_VALIDITY']
+        cert_key = cert_key_from_path(path)
+        with get_upstream_session(user, cert_key) as upstream_session:
+            r = upstream_request(
+                upstream_session, 'POST', path,
+                headers={'Content-Type': 'application/macaroon-request'},
+                json={'caveats': ['activity:DOWNLOAD'],
+                      'validity': f'PT{validity}S'})
+
+        if r.status_code != 200:
+            return 'Error: unable to obtain upstream credential: ' + \
+                f'{r.status_code} {r.content.decode()}', 502
+
+        location = r.json()['uri']['targetWithMacaroon']
+
+        # keep a margin for the client to follow the redirect
+        get_cache('fetch_redirect').set(
+            (username, path), location, validity - min(60, validity / 5))
+
+    return redirect(location, 307)
 
 
 @app.route(url_prefix + '/fetch', methods=['GET', 'POST'],
@@ -346,40 +1094,88 @@ def fetch(user, path):
     if '..' in path:
         return "Error: path cannot contain '..'", 400
 
-    url = urljoin_multipart(app.config['CTADS_UPSTREAM_ENDPOINT'],
-                            app.config['CTADS_UPSTREAM_BASEPATH'],
-                            (path or ''))
+    if request.args.get('mode') == 'redirect':
+        if not app.config['CTADS_FETCH_REDIRECT']:
+            return 'Error: redirect mode is not enabled', 400
+        return fetch_redirect(user, path)
 
     chunk_size = request.args.get('chunk_size', default_chunk_size, type=int)
 
-    logger.info('fetching upstream url %s', url)
+    logger.info('fetching upstream path %s', path)
 
     filename = os.path.basename(path)
 
+    cert_key = cert_key_from_path(path)
+    slot = acquire_transfer_slot(user, cert_key)
+
     try:
-        cert_key = cert_key_from_path(path)
         context = get_upstream_session(user, cert_key)
         upstream_session = context.__enter__()
     except Exception:
+        slot.release()
+        context.__exit__(None, None, None)
+        raise
+
+    def open_upstream(headers=None):
+        return upstream_request(
+            upstream_session, 'GET', path, headers=headers, stream=True,
+            timeout=(app.config['CTADS_TRANSFER_CONNECT_TIMEOUT'],
+                     app.config['CTADS_FETCH_READ_TIMEOUT']))
+
+    try:
+        f = open_upstream()
+    except Exception:
+        slot.release()
         context.__exit__(None, None, None)
         raise
 
+    logger.debug('got response headers: %s', f.headers)
+    logger.info('opened %s', f)
+
+    if f.status_code != 200:
+        content = f.content
+        f.close()
+        slot.release()
+        context.__exit__(None, None, None)
+        return f'Error: {f.status_code} {content.decode()}', f.status_code
+
+    reader = ResumingReader(f, open_upstream, chunk_size,
+                            app.config['CTADS_FETCH_MAX_RESUMES'])
+
+    # the upstream is read independently of the client pace
+    chunks = reader
+    if app.config['CTADS_FETCH_READ_AHEAD'] > 0:
+        chunks = ReadAhead(reader, get_read_ahead_pool(),
+                           app.config['CTADS_FETCH_READ_AHEAD'],
+                           app.config['CTADS_FETCH_SPILL_DIR'],
+                           app.config['CTADS_FETCH_SPILL_SIZE'])
+
     def generate():
         try:
-            with upstream_session.get(url, stream=True) as f:
-                logger.debug('got response headers: %s', f.headers)
-                logger.info('opened %s', f)
-                for r in f.iter_content(chunk_size=chunk_size):
-                    yield r
+            for r in throttled(chunks, slot):
+                yield r
+        except ResumeError as e:
+            logger.error('aborting fetch of %s: %s', path, e)
+            capture_exception(e)
+            raise
         finally:
+            if isinstance(chunks, ReadAhead):
+                chunks.close()
+            f.close()
             context.__exit__(None, None, None)
 
-    return Response(
-        stream_with_context(generate()),
-        headers={
-            'Content-Disposition': f'attachment; filename={filename}',
-            'Content-Type': 'application/octet-stream'
-        })
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Content-Type': 'application/octet-stream'
+    }
+    if reader.length is not None:
+        headers['Content-Length'] = str(reader.length)
+
+    response = Response(stream_with_context(generate()), headers=headers)
+    # also released when the client goes away before the body starts
+    response.call_on_close(slot.release)
+
+    return response
     # TODO print useful logs for loki
 
 
@@ -390,15 +1186,12 @@ def user_to_path_fragment(user):
     return re.sub('[^0-1a-z]', '_', user.lower())
 
 
-@app.route(url_prefix + '/upload', methods=['POST'], defaults={'path': None})
-@app.route(url_prefix + '/upload/<path:path>', methods=['POST'])
-@authenticated
-def upload(user, path):
-    # TODO: Not secure for production
-    if '..' in path:
-        return "Error: path cannot contain '..'", 400
+def select_upload_base_folder():
+    """First upload folder whose users directory is accessible.
 
-    # check if upload folder is accessible
+    Returns the folder and its users directory, the folder is None when
+    none is accessible.
+    """
     potential_folders = app.config['CTADS_UPSTREAM_UPLOAD_FOLDERS']
     selected_base_folder = None
     joined_path = None
@@ -409,8 +1202,8 @@ def upload(user, path):
                 path=joined_path)
 
             logger.info(
-                'trying base_folder %s and joined_url %s returns %s', path,
-                joined_path, status_code)
+                'trying base_folder %s and joined_url %s returns %s',
+                base_folder, joined_path, status_code)
 
             if status_code not in [200, 207]:
                 continue
@@ -424,6 +1217,32 @@ def upload(user, path):
     logger.info('selected_base_folder %s joined_path %s',
                 selected_base_folder, joined_path)
 
+    return selected_base_folder, joined_path
+
+
+def upload_already_present(upstream_session, upload_path):
+    """Whether the upstream file has the size and checksums announced by the
+    client in the Content-Length and Digest headers of the upload."""
+    digests = parse_digest(request.headers.get('Digest'))
+    if not digests or request.content_length is None:
+        return False
+
+    entry = stat_path(upstream_session, upload_path, checksums=True)
+    return entry.get('type') == 'file' and \
+        entry['size'] == request.content_length and \
+        digests_match(digests, entry['checksums'])
+
+
+@app.route(url_prefix + '/upload', methods=['POST'], defaults={'path': None})
+@app.route(url_prefix + '/upload/<path:path>', methods=['POST'])
+@authenticated
+def upload(user, path):
+    # TODO: Not secure for production
+    if '..' in path:
+        return "Error: path cannot contain '..'", 400
+
+    # check if upload folder is accessible
+    selected_base_folder, joined_path = select_upload_base_folder()
     if selected_base_folder is None:
         return 'Access denied', \
             '403 Missing rights to upload files'
@@ -434,58 +1253,206 @@ def upload(user, path):
         user_to_path_fragment(user))
     upload_path = urljoin_multipart(upload_base_path, path)
 
-    baseurl = urljoin_multipart(
-        app.config['CTADS_UPSTREAM_ENDPOINT'],
-        app.config['CTADS_UPSTREAM_BASEPATH'],
-        upload_base_path
-    )
-
-    url = urljoin_multipart(baseurl, path)
-
     chunk_size = request.args.get('chunk_size', default_chunk_size, type=int)
 
     logger.info('uploading to path %s', path)
-    logger.info('uploading to base upstream url %s', baseurl)
-    logger.info('uploading to upstream url %s', url)
+    logger.info('uploading to upstream path %s', upload_path)
     logger.info('uploading chunk size %s', chunk_size)
 
     cert_key = cert_key_from_path(joined_path)
     logger.info('cert key from path %s is %s', joined_path, cert_key)
-    with get_upstream_session(user, cert_key) as upstream_session:
-        r = upstream_session.request('MKCOL', baseurl)
+    slot = acquire_transfer_slot(user, cert_key)
+    try:
+        with get_upstream_session(user, cert_key) as upstream_session:
+            # the body is not read, with Expect: 100-continue not even sent
+            if upload_already_present(upstream_session, upload_path):
+                logger.info('%s already present, skipping upload', upload_path)
+                return {
+                    'status': 'already present',
+                    'path': upload_path,
+                    'total_written': 0
+                }
+
+            r = upstream_request(upstream_session, 'MKCOL', upload_base_path)
+
+            body = upstream_request_body(chunk_size, slot.throttle)
+            try:
+                r = upstream_request(upstream_session, 'PUT', upload_path,
+                                     data=body)
+            finally:
+                slot.release()
+                if isinstance(body, PipelinedReader):
+                    body.close()
+                    total_written = body.total_read
+                else:
+                    total_written = len(body)
+
+            logger.info('%s %s %s, written %s Mb', upload_path, r, r.text,
+                        total_written/1024**2)
+
+            if r.status_code not in [200, 201, 204]:
+                return f'Error: {r.status_code} {r.content.decode()}', \
+                    r.status_code
+            else:
+                return {
+                    'status': 'uploaded',
+                    'path': upload_path,
+                    'total_written': total_written
+                }
 
-        stats = dict(total_written=0)
+            # TODO: first simple and safe mechanism would be to let users
+            # upload only to their own specialized directory with hashed name
 
-        def generate(stats):
-            while r := request.stream.read(chunk_size):
-                logger.info('read %s Mb total %s Mb',
-                            len(r)/1024**2, stats['total_written']/1024**2)
-                stats['total_written'] += len(r)
-                yield r
+            # return Response(stream_with_context(generate())), headers
+            # TODO print useful logs for loki
+    finally:
+        slot.release()
 
-        r = upstream_session.put(url, data=generate(stats))
 
-        logger.info('%s %s %s', url, r, r.text)
+@app.route(url_prefix + '/upload-tar', methods=['POST'],
+           defaults={'path': ''})
+@app.route(url_prefix + '/upload-tar/<path:path>', methods=['POST'])
+@authenticated
+def upload_tar(user, path):
+    """Unpack a tar stream into the user upload area.
 
-        if r.status_code not in [200, 201]:
-            return f'Error: {r.status_code} {r.content.decode()}', \
-                r.status_code
-        else:
-            return {
-                'status': 'uploaded',
-                'path': upload_path,
-                'total_written': stats['total_written']
-            }
+    Members are read as the archive arrives: small ones are buffered and
+    uploaded concurrently, larger ones are streamed upstream directly.
+    Collections are created once. Returns a per-file manifest.
+    """
+    if '..' in path:
+        return "Error: path cannot contain '..'", 400
 
-        # TODO: first simple and safe mechanism would be to let users upload
-        # only to their own specialized directory with hashed name
+    selected_base_folder, joined_path = select_upload_base_folder()
+    if selected_base_folder is None:
+        return 'Access denied', \
+            '403 Missing rights to upload files'
 
-        # return Response(stream_with_context(generate())), headers
-        # TODO print useful logs for loki
+    upload_base_path = urljoin_multipart(
+        selected_base_folder,
+        'users',
+        user_to_path_fragment(user))
+    target_path = urljoin_multipart(upload_base_path, path)
+
+    concurrency = app.config['CTADS_TAR_CONCURRENCY']
+    buffer_size = app.config['CTADS_TAR_MEMBER_BUFFER_SIZE']
+
+    manifest = []
+    created = set()
+    error = None
+
+    def ensure_collection(upstream_session, collection):
+        parts = [upload_base_path] + \
+            [p for p in collection.split('/') if p != '']
+        for n in range(1, len(parts) + 1):
+            prefix = urljoin_multipart(*parts[:n])
+            if prefix not in created:
+                upstream_request(upstream_session, 'MKCOL', prefix)
+                created.add(prefix)
+
+    def put(upstream_session, result, data):
+        try:
+            r = upstream_request(upstream_session, 'PUT', result['path'],
+                                 data=data)
+            if r.status_code in [200, 201, 204]:
+                result['status'] = 'uploaded'
+            else:
+                result.update(status='error',
+                              error=f'{r.status_code} {r.reason}')
+        except requests.exceptions.RequestException as e:
+            result.update(status='error', error=str(e))
+        finally:
+            if isinstance(data, PipelinedReader):
+                data.close()
+
+    cert_key = cert_key_from_path(joined_path)
+    slot = acquire_transfer_slot(user, cert_key)
+    try:
+        stream = ThrottledStream(request.stream, slot.throttle)
+        with get_upstream_session(user, cert_key) as upstream_session:
+            adapter = HTTPAdapter(pool_maxsize=concurrency)
+            upstream_session.mount('http://', adapter)
+            upstream_session.mount('https://', adapter)
+
+            # bounds the buffered members waiting for upload
+            slots = threading.BoundedSemaphore(2 * concurrency)
+
+            def put_buffered(result, data):
+                try:
+                    put(upstream_session, result, data)
+                finally:
+                    slots.release()
+
+            with ThreadPoolExecutor(concurrency) as pool:
+                try:
+                    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+                        for member in tar:
+                            name = os.path.normpath(member.name)
+                            if member.isdir():
+                                if not name.startswith('..') and \
+                                        not os.path.isabs(name):
+                                    ensure_collection(
+                                        upstream_session,
+                                        urljoin_multipart(path, name))
+                                continue
+
+                            result = dict(name=member.name, size=member.size)
+                            manifest.append(result)
+
+                            if name.startswith('..') or os.path.isabs(name):
+                                result.update(status='error',
+                                              error='invalid member name')
+                                continue
+                            if not member.isfile():
+                                result.update(status='error',
+                                              error='not a regular file')
+                                continue
+
+                            result['path'] = urljoin_multipart(
+                                target_path, name)
+                            ensure_collection(
+                                upstream_session,
+                                urljoin_multipart(path, os.path.dirname(name)))
+
+                            f = tar.extractfile(member)
+                            if member.size <= buffer_size:
+                                data = f.read()
+                                slots.acquire()
+                                pool.submit(put_buffered, result, data)
+                            else:
+                                put(upstream_session, result, PipelinedReader(
+                                    f, default_chunk_size,
+                                    app.config['CTADS_UPLOAD_PIPELINE_DEPTH'],
+                                    member.size))
+                except (tarfile.TarError, EOFError) as e:
+                    logger.error('Error while reading tar stream: %s', e)
+                    error = f'invalid tar stream: {e}'
+                finally:
+                    slot.release()
+    finally:
+        slot.release()
+
+    uploaded = [r for r in manifest if r.get('status') == 'uploaded']
+    response = {
+        'status': 'uploaded' if error is None and
+        len(uploaded) == len(manifest) else 'partial',
+        'path': target_path,
+        'total_written': sum(r['size'] for r in uploaded),
+        'files': manifest,
+    }
+    if error is not None:
+        response['error'] = error
+        return response, 400
+
+    return response
 
 
 @app.route(url_prefix + '/oauth_callback')
 def oauth_callback():
+    auth = get_auth()
+    if auth is None:
+        return 'Error: auth system not configured', 500
+
     code = request.args.get('code', None)
     if code is None:
         return 'Error: oauth callback code', 403
@@ -506,38 +1473,144 @@ def oauth_callback():
 
 webdav_methods = ['GET', 'HEAD',  'MKCOL', 'OPTIONS',
                   'PROPFIND', 'PROPPATCH', 'PUT', 'TRACE',
-                  # 'LOCK', 'UNLOCK', 'POST', 'DELETE', 'MOVE',
+                  'COPY', 'MOVE', 'DELETE',
+                  # 'LOCK', 'UNLOCK', 'POST',
                   ]
 
 
+def writable_path(user, path):
+    """Whether `path` is in the user directory of an upload folder."""
+    if '..' in path:
+        return False
+
+    for base_folder in app.config['CTADS_UPSTREAM_UPLOAD_FOLDERS']:
+        required_path_prefix = urljoin_multipart(
+            base_folder,
+            'users',
+            user_to_path_fragment(user)) + '/'
+        if path.startswith(required_path_prefix):
+            return True
+    return False
+
+
+def webdav_destination(value):
+    """Path of a Destination header pointing to /webdav, None otherwise."""
+    endpoint_prefix = '/' + urljoin_multipart(url_prefix, 'webdav') + '/'
+    path = unquote(urlparse(value or '').path)
+    if not path.startswith(endpoint_prefix):
+        return None
+    return path[len(endpoint_prefix):]
+
+
+def list_tree(upstream_session, path, concurrency):
+    """Files and directories below `path`, listed level by level with
+    concurrent PROPFINDs. Directories are returned parents first.
+
+    Paths, `path` included, are percent-encoded as in the hrefs of the
+    storage, so that names with `#`, `?` or `%` are sent as they are.
+    """
+    basepath = app.config['CTADS_UPSTREAM_BASEPATH']
+
+    def children(directory):
+        r = upstream_request(upstream_session, 'PROPFIND', directory,
+                             headers={'Depth': '1'})
+        if r.status_code not in [200, 207]:
+            raise requests.exceptions.HTTPError(
+                f'listing {unquote(directory)}: {r.status_code} {r.reason}',
+                response=r)
+        return [
+            strip_basepath(href, basepath)
+            for href, _, _ in iter_multistatus(r.content)
+            if unquote(strip_basepath(href, basepath)).strip('/') !=
+            unquote(directory).strip('/')
+        ]
+
+    files, directories = [], []
+    level = [path]
+    with ThreadPoolExecutor(concurrency) as pool:
+        while level:
+            entries = [e for c in pool.map(children, level) for e in c]
+            files += [e for e in entries if entry_type(e) == 'file']
+            level = [e for e in entries if entry_type(e) == 'directory']
+            directories += level
+    return files, directories
+
+
+def delete_tree(upstream_session, path):
+    """Delete `path` upstream, emptying directories first.
+
+    Files are deleted with CTADS_DELETE_CONCURRENCY concurrent requests,
+    then directories from the deepest. Returns the percent-encoded paths
+    which could not be deleted, with their status.
+    """
+    concurrency = app.config['CTADS_DELETE_CONCURRENCY']
+    adapter = HTTPAdapter(pool_maxsize=concurrency)
+    upstream_session.mount('http://', adapter)
+    upstream_session.mount('https://', adapter)
+
+    path = quote(path)
+    files, directories = list_tree(upstream_session, path, concurrency)
+
+    def delete(p):
+        r = upstream_request(upstream_session, 'DELETE', p)
+        return p, r.status_code, r.reason
+
+    failed = []
+    with ThreadPoolExecutor(concurrency) as pool:
+        batches = [files] + [
+            [d for d in directories if d.count('/') == depth]
+            for depth in sorted({d.count('/') for d in directories},
+                                reverse=True)
+        ] + [[path]]
+        for batch in batches:
+            # everything was just listed, a 404 is a path gone astray
+            failed += [result for result in pool.map(delete, batch)
+                       if result[1] not in [200, 202, 204]]
+    return failed
+
+
+def multistatus(results):
+    """207 Multi-Status body reporting the status of /webdav paths."""
+    endpoint_prefix = '/' + urljoin_multipart(url_prefix, 'webdav')
+    root = ET.Element('{DAV:}multistatus')
+    for path, status_code, reason in results:
+        response = ET.SubElement(root, '{DAV:}response')
+        ET.SubElement(response, '{DAV:}href').text = \
+            endpoint_prefix + '/' + path
+        ET.SubElement(response, '{DAV:}status').text = \
+            f'HTTP/1.1 {status_code} {reason}'
+    return ET.tostring(root, xml_declaration=True, encoding='utf-8')
+
+
 @app.route(url_prefix + '/webdav', defaults={'path': ''},
            methods=webdav_methods)
 @app.route(url_prefix + '/webdav/<path:path>', methods=webdav_methods)
 @authenticated
 def webdav(user, path):
-    API_HOST = urljoin_multipart(
-        app.config['CTADS_UPSTREAM_ENDPOINT'],
-        app.config['CTADS_UPSTREAM_BASEPATH'],
-    )
-
-    if request.method not in ['GET', 'HEAD', 'OPTIONS', 'PROPFIND', 'TRACE']:
+    # COPY only reads its source
+    if request.method not in ['GET', 'HEAD', 'OPTIONS', 'PROPFIND', 'TRACE',
+                              'COPY']:
         # check if upload folder is accessible
-        potential_folders = app.config['CTADS_UPSTREAM_UPLOAD_FOLDERS']
-        selected_base_folder = None
-        for base_folder in potential_folders:
-            required_path_prefix = urljoin_multipart(
-                base_folder,
-                'users',
-                user_to_path_fragment(user)) + '/'
-            if path.startswith(required_path_prefix):
-                selected_base_folder = base_folder
-                break
-
-        if selected_base_folder is None:
+        if not writable_path(user, path):
             return 'Access denied', \
                 f'403 Missing rights to write in : {path}, ' + \
                 'you are not allowed to write in this folder'
 
+    cert_key = cert_key_from_path(path)
+
+    destination = None
+    if request.method in ['COPY', 'MOVE']:
+        destination = webdav_destination(request.headers.get('Destination'))
+        if destination is None:
+            return 'Error: Destination must be a path of this service', 400
+        if not writable_path(user, destination):
+            return 'Access denied', \
+                f'403 Missing rights to write in : {destination}, ' + \
+                'you are not allowed to write in this folder'
+        if cert_key_from_path(destination) != cert_key:
+            return 'Error: Destination must be in the same storage area', \
+                502
+
     # Exclude all "hop-by-hop headers" defined by RFC 2616
     # section 13.5.1 ref. https://www.rfc-editor.org/rfc/rfc2616#section-13.5.1
     excluded_headers = ['content-encoding', 'content-length',
@@ -545,23 +1618,63 @@ def webdav(user, path):
                         'proxy-authenticate', 'proxy-authorization', 'te',
                         'trailers', 'upgrade']
 
-    def request_datastream():
-        while (buf := request.stream.read(default_chunk_size)) != b'':
-            yield buf
+    # only file transfers are subject to the transfer limits
+    slot = None
+    if request.method in ['GET', 'PUT']:
+        slot = acquire_transfer_slot(user, cert_key)
 
-    cert_key = cert_key_from_path(path)
+    try:
+        return webdav_upstream(user, path, cert_key, destination, slot,
+                               excluded_headers)
+    except Exception:
+        if slot is not None:
+            slot.release()
+        raise
+
+
+def webdav_upstream(user, path, cert_key, destination, slot,
+                    excluded_headers):
+    """Forward the /webdav request upstream; `slot` is released once the
+    response is sent."""
     with get_upstream_session(user, cert_key) as upstream_session:
-        res = upstream_session.request(
-            method=request.method,
-            url=urljoin_multipart(API_HOST, path),
-            # exclude 'host' and 'authorization' header
-            headers={k: v for k, v in request.headers
-                     if k.lower() not in ['host', 'authorization'] and
-                     k.lower() not in excluded_headers},
-            data=request_datastream(),
-            cookies=request.cookies,
-            allow_redirects=False,
-        )
+        if request.method == 'DELETE':
+            try:
+                failed = delete_tree(upstream_session, path)
+            except requests.exceptions.HTTPError as e:
+                return f'Error: {e}', e.response.status_code
+            except (requests.exceptions.RequestException,
+                    ET.ParseError) as e:
+                logger.error('Error while deleting %s: %s', path, e)
+                return f'Error: {e}', 502
+            if failed:
+                return Response(multistatus(failed), 207,
+                                mimetype='application/xml')
+            return '', 204
+
+        body = b''
+        try:
+            body = upstream_request_body(
+                default_chunk_size, slot and slot.throttle)
+            res = upstream_request(
+                upstream_session,
+                request.method,
+                path,
+                destination=destination,
+                # exclude 'host', 'authorization' and the rewritten
+                # 'destination' header
+                headers={k: v for k, v in request.headers
+                         if k.lower() not in ['host', 'authorization',
+                                              'destination'] and
+                         k.lower() not in excluded_headers},
+                data=body,
+                cookies=request.cookies,
+                allow_redirects=False,
+                # files are read at the pace of the client
+                stream=request.method == 'GET',
+            )
+        finally:
+            if isinstance(body, PipelinedReader):
+                body.close()
 
         headers = [
             (k, v) for k, v in res.raw.headers.items()
@@ -580,8 +1693,24 @@ def webdav(user, path):
                 (':href>'+base_path).encode(),
                 (':href>'+endpoint_prefix + "/").encode())
 
-        return Response(
-            prop_content() if is_prop_method else res.content,
+        if is_prop_method():
+            content = prop_content()
+        elif request.method == 'GET':
+            content = throttled(res.iter_content(default_chunk_size), slot)
+        else:
+            content = res.content
+
+        if slot is not None and request.method == 'PUT':
+            slot.release()
+
+        response = Response(
+            content,
             res.status_code,
             headers
         )
+        if slot is not None:
+            # also released when the client goes away before the body starts
+            response.call_on_close(slot.release)
+        response.call_on_close(res.close)
+
+        return response
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    def __init__(self, message="upstream unavailable", retry_after=30):
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(self.message)
+
+
+class CircuitBreaker:
+    """Fail fast while an upstream is unhealthy.
+
+    After `threshold` consecutive failures the circuit opens: calls are
+    refused with CircuitOpen for `reset_timeout` seconds. It then turns
+    half-open and lets `half_open_calls` probe calls through; a success
+    closes the circuit, a failure opens it again. A threshold of 0 disables
+    the breaker.
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=30,
+                 half_open_calls=1):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probes = 0
+        self.probe_started = None
+        self.rejected = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Admit a call, or raise CircuitOpen."""
+        if self.threshold <= 0:
+            return
+
+        with self._lock:
+            if self.state == 'open':
+                wait = self.opened_at + self.reset_timeout - time.monotonic()
+                if wait > 0:
+                    self.rejected += 1
+                    raise CircuitOpen(
+                        f'{self.name} is unavailable: {self.last_error}',
+                        int(wait) + 1)
+                self.state = 'half-open'
+                self.probes = 0
+
+            if self.state == 'half-open':
+                now = time.monotonic()
+                if self.probes >= self.half_open_calls:
+                    if now - self.probe_started < self.reset_timeout:
+                        self.rejected += 1
+                        raise CircuitOpen(
+                            f'{self.name} is unavailable, checking recovery',
+                            self.reset_timeout)
+                    # probes which never reported are given up
+                    self.probes = 0
+                if self.probes == 0:
+                    self.probe_started = now
+                self.probes += 1
+
+    def success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info('%s recovered, closing circuit', self.name)
+            self.state = 'closed'
+            self.consecutive_failures = 0
+
+    def failure(self, error):
+        if self.threshold <= 0:
+            return
+
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.state == 'half-open' or \
+                    self.consecutive_failures >= self.threshold:
+                if self.state != 'open':
+                    logger.error('%s failed %s times, opening circuit: %s',
+                                 self.name, self.consecutive_failures, error)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return dict(state=self.state,
+                        consecutive_failures=self.consecutive_failures,
+                        rejected=self.rejected,
+                        last_error=self.last_error)
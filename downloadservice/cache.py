@@ -0,0 +1,106 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class ExpiringCache:
+    """Thread-safe mapping whose entries expire after their own lifetime.
+
+    When `max_size` entries are stored, expired entries are dropped first,
+    then the ones closest to expiry.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value, max_age):
+        with self._lock:
+            if key not in self._entries and \
+                    len(self._entries) >= self.max_size:
+                self._evict()
+            self._entries[key] = (time.time() + max_age, value)
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, (expires, _) in self._entries.items()
+                    if expires <= now]:
+            del self._entries[key]
+        while len(self._entries) >= self.max_size:
+            del self._entries[min(self._entries,
+                                  key=lambda k: self._entries[k][0])]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SharedExpiringCache:
+    """ExpiringCache stored in SQLite, shared by the processes using the same
+    `path`. Keys and values must be JSON serializable."""
+
+    def __init__(self, path, namespace, max_size=10000):
+        self.namespace = namespace
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     timeout=10)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'namespace TEXT, key TEXT, expires REAL, value TEXT, '
+                'PRIMARY KEY (namespace, key))')
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM cache WHERE namespace = ? AND key = ? '
+                'AND expires > ?',
+                (self.namespace, json.dumps(key), time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, max_age):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                (self.namespace, json.dumps(key), now + max_age,
+                 json.dumps(value)))
+            self._conn.execute(
+                'DELETE FROM cache WHERE namespace = ? AND expires <= ?',
+                (self.namespace, now))
+            self._conn.execute(
+                'DELETE FROM cache WHERE namespace = ? AND key IN ('
+                'SELECT key FROM cache WHERE namespace = ? '
+                'ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                (self.namespace, self.namespace, self.max_size))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM cache WHERE namespace = ?',
+                               (self.namespace,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT count(*) FROM cache WHERE namespace = ? '
+                'AND expires > ?',
+                (self.namespace, time.time())).fetchone()[0]
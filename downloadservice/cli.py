@@ -1,18 +1,356 @@
+import argparse
 import logging
+import os
+import random
+import select
+import signal
+import threading
+import time
 
-from downloadservice.app import app
+from downloadservice.app import (
+    app, forget_transfers, get_lane_scheduler, start_background_tasks
+)
 
+import cheroot
+from cheroot.server import HTTPConnection, HTTPRequest
 from cheroot.wsgi import PathInfoDispatcher
 from cheroot.wsgi import Server
 
+logger = logging.getLogger(__name__)
+
+
+class RequestCounter:
+    """WSGI middleware calling `on_limit` once `max_requests` requests were
+    received."""
+
+    def __init__(self, wsgi_app, max_requests, on_limit):
+        self.wsgi_app = wsgi_app
+        self.max_requests = max_requests
+        self.on_limit = on_limit
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+            reached = self.count == self.max_requests
+        if reached:
+            self.on_limit()
+        return self.wsgi_app(environ, start_response)
+
+
+class ContinueFilter:
+    """Connection output dropping the "100 Continue" that cheroot sends as
+    soon as it receives the request headers."""
+
+    def __init__(self, wfile, request):
+        self.wfile = wfile
+        self.request = request
+
+    def write(self, data):
+        if data == self.request.continue_message():
+            self.request.continue_pending = True
+            return len(data)
+        return self.wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
+
+class ContinueOnRead:
+    """Connection input sending the pending "100 Continue" on first read."""
+
+    def __init__(self, rfile, request):
+        self.rfile = rfile
+        self.request = request
+
+    def read(self, *args):
+        self.request.send_continue()
+        return self.rfile.read(*args)
+
+    def readline(self, *args):
+        self.request.send_continue()
+        return self.rfile.readline(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.rfile, name)
+
+
+class DeferredContinueRequest(HTTPRequest):
+    """Request answering `Expect: 100-continue` only when the application
+    reads the body.
+
+    A request answered without reading its body, like the upload of a file
+    already present upstream, is then never sent by the client. The
+    connection is closed after such a response.
+    """
+
+    continue_pending = False
+    # whether cheroot was seen sending the "100 Continue" around the filter
+    continue_warned = False
+
+    def continue_message(self):
+        return self.server.protocol.encode('ascii') + b' 100 Continue\r\n\r\n'
+
+    def read_request_headers(self):
+        wfile = self.conn.wfile
+        self.conn.wfile = ContinueFilter(wfile, self)
+        try:
+            ok = super().read_request_headers()
+        finally:
+            self.conn.wfile = wfile
+
+        if ok and not self.continue_pending and \
+                self.inheaders.get(b'Expect', b'') == b'100-continue' and \
+                not DeferredContinueRequest.continue_warned:
+            # this cheroot answers otherwise, and keeps doing so
+            DeferredContinueRequest.continue_warned = True
+            logger.warning('"100 Continue" is not deferred with cheroot %s, '
+                           'uploads of files already present are sent '
+                           'anyway', cheroot.__version__)
+        return ok
+
+    def send_continue(self):
+        if self.continue_pending and not self.sent_headers:
+            self.continue_pending = False
+            self.conn.wfile.write(self.continue_message())
+
+    def respond(self):
+        if not self.continue_pending:
+            return super().respond()
+
+        rfile = self.conn.rfile
+        self.conn.rfile = ContinueOnRead(rfile, self)
+        try:
+            return super().respond()
+        finally:
+            self.conn.rfile = rfile
+
+    def send_headers(self):
+        if self.continue_pending:
+            # the body was not sent, and must not be read as the next request
+            self.close_connection = True
+        return super().send_headers()
+
+
+class DeferredContinueConnection(HTTPConnection):
+    RequestHandlerClass = DeferredContinueRequest
+
+
+def server_threads(args):
+    """At least one thread per running and queued request of the lanes, so
+    that requests only ever wait in their lane."""
+    scheduler = get_lane_scheduler()
+    needed = scheduler.threads() if scheduler else None
+    if needed is not None and needed > args.threads:
+        logger.info('using %s threads for the scheduling lanes', needed)
+        return needed
+    return args.threads
+
+
+def make_server(args, wsgi_app):
+    d = PathInfoDispatcher({'/': wsgi_app})
+    # a recycled worker shares the port with its replacement
+    server = Server((args.host, args.port), d,
+                    numthreads=server_threads(args),
+                    reuse_port=args.workers > 1 or args.max_requests > 0)
+    server.ConnectionClass = DeferredContinueConnection
+    # requests in progress when stopping are cut after this time
+    server.shutdown_timeout = args.drain_timeout
+    return server
+
+
+def notify(fd, message):
+    """Send `message` about this worker to the master; a single write to
+    the pipe is atomic."""
+    os.write(fd, f'{message} {os.getpid()}\n'.encode())
+
+
+def run_worker(args, worker_id, notify_fd):
+    """Serve until SIGTERM, then stop gracefully.
+
+    After `max_requests` requests, plus up to `max_requests_jitter` so that
+    workers are not recycled together, the master is asked for a
+    replacement; the worker keeps serving until the replacement listens.
+    """
+    app.config['CTADS_INDEX_CRAWL'] = worker_id == 0
+    app.config['CTADS_STORAGE_STATUS_PROBE'] = \
+        worker_id == 0 or not app.config['CTADS_SHARED_CACHE_PATH']
+    # each worker checks the endpoints it chooses from, all together as
+    # often as a single process
+    app.config['CTADS_UPSTREAM_PROBE_INTERVAL'] *= args.workers
+    start_background_tasks()
+
+    stopping = threading.Event()
+
+    wsgi_app = app
+    if args.max_requests > 0:
+        max_requests = args.max_requests + \
+            random.randint(0, args.max_requests_jitter)
+        wsgi_app = RequestCounter(app, max_requests,
+                                  lambda: notify(notify_fd, 'recycle'))
+
+    server = make_server(args, wsgi_app)
+    # stop() has no effect on a server not yet bound
+    server.prepare()
+
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    def stop_when_requested():
+        stopping.wait()
+        logger.info('worker %s (pid %s) stopping', worker_id, os.getpid())
+        server.stop()
+
+    threading.Thread(target=stop_when_requested, daemon=True).start()
+
+    logger.info('worker %s (pid %s) started', worker_id, os.getpid())
+    notify(notify_fd, 'ready')
+    server.serve()
+
+
+def run_workers(args):
+    """Fork `args.workers` workers sharing the listen port with SO_REUSEPORT,
+    and start a new one whenever one exits.
+
+    A worker asking to be recycled is only stopped once its replacement
+    listens, so that the port is never left without a worker.
+    """
+    workers = {}
+    # replacement pid: pid of the worker it replaces
+    replacing = {}
+    recycled = set()
+    stopping = []
+    notify_r, notify_w = os.pipe()
+
+    def spawn(worker_id, replaces=None):
+        pid = os.fork()
+        if pid == 0:
+            # the handlers of the master must not run in the worker
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.close(notify_r)
+            code = 0
+            try:
+                run_worker(args, worker_id, notify_w)
+            except Exception:
+                logger.exception('worker %s failed', worker_id)
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = (worker_id, time.time())
+        if replaces is not None:
+            replacing[pid] = replaces
+        if stopping:
+            os.kill(pid, signal.SIGTERM)
+
+    def terminate(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def handle(message):
+        kind, pid = message.split()
+        pid = int(pid)
+        if pid not in workers or stopping:
+            return
+        if kind == 'recycle' and pid not in recycled:
+            logger.info('worker %s (pid %s) reached its requests, '
+                        'starting its replacement', workers[pid][0], pid)
+            recycled.add(pid)
+            spawn(workers[pid][0], replaces=pid)
+        elif kind == 'ready' and pid in replacing:
+            replaced = replacing.pop(pid)
+            if replaced in workers:
+                os.kill(replaced, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    for worker_id in range(args.workers):
+        spawn(worker_id)
+
+    buffered = b''
+    while workers:
+        readable, _, _ = select.select([notify_r], [], [], 0.5)
+        if readable:
+            buffered += os.read(notify_r, 4096)
+            *messages, buffered = buffered.split(b'\n')
+            for message in messages:
+                handle(message.decode())
+
+        while workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                break
+
+            worker_id, started = workers.pop(pid)
+            replaces = replacing.pop(pid, None)
+            # its transfers are over
+            forget_transfers(pid)
+            if stopping or pid in recycled:
+                recycled.discard(pid)
+                continue
+
+            logger.info('worker %s exited with status %s, restarting',
+                        worker_id, status)
+            if status != 0 and time.time() - started < 1:
+                # avoid restarting in a loop a worker failing on start
+                time.sleep(1)
+            spawn(worker_id, replaces)
+
 
 def main():
     logging.basicConfig(level=logging.DEBUG)
 
-    d = PathInfoDispatcher({'/': app})
-    server = Server(('0.0.0.0', 5000), d)
-    logger = logging.getLogger(__name__)
-    logger.info("Serving on http://0.0.0.0:5000")
+    parser = argparse.ArgumentParser(description='Run the downloadservice')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument(
+        '--workers', type=int,
+        default=int(os.getenv('CTADS_WORKERS', '1')),
+        help='number of worker processes')
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.getenv('CTADS_THREADS', '10')),
+        help='number of request threads per worker')
+    parser.add_argument(
+        '--max-requests', type=int,
+        default=int(os.getenv('CTADS_WORKER_MAX_REQUESTS', '0')),
+        help='requests after which a worker is replaced, 0 for never')
+    parser.add_argument(
+        '--max-requests-jitter', type=int,
+        default=os.getenv('CTADS_WORKER_MAX_REQUESTS_JITTER'),
+        help='random requests added to the limit of each worker, by '
+        'default a tenth of --max-requests')
+    parser.add_argument(
+        '--drain-timeout', type=float,
+        default=float(os.getenv('CTADS_WORKER_DRAIN_TIMEOUT', '300')),
+        help='seconds given to the requests in progress of a stopping '
+        'worker')
+    args = parser.parse_args()
+    if args.max_requests_jitter is None:
+        args.max_requests_jitter = args.max_requests // 10
+    args.max_requests_jitter = int(args.max_requests_jitter)
+
+    # transfers counted by processes of a previous run are over
+    forget_transfers()
+
+    if args.workers > 1 or args.max_requests > 0:
+        if args.workers > 1 and not app.config['CTADS_SHARED_CACHE_PATH']:
+            logger.warning('CTADS_SHARED_CACHE_PATH is not set, transfer '
+                           'limits and storage probes are per worker')
+        logger.info("Serving on http://%s:%s", args.host, args.port)
+        run_workers(args)
+        return
+
+    start_background_tasks()
+
+    server = make_server(args, app)
+    logger.info("Serving on http://%s:%s", args.host, args.port)
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,87 @@
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    logger.info('zstandard not available, zstd encoding disabled')
+    zstandard = None
+
+compressible_mimetypes = ['application/json', 'application/x-ndjson',
+                          'application/msgpack', 'application/xml',
+                          'text/xml']
+
+slice_size = 64 * 1024
+
+
+def available_encodings():
+    """Supported content-encodings, in order of preference."""
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+
+def _slices(chunks):
+    for chunk in chunks:
+        for i in range(0, len(chunk), slice_size):
+            yield chunk[i:i+slice_size]
+
+
+def gzip_stream(chunks, level):
+    # wbits=31 selects the gzip container
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in _slices(chunks):
+        if out := compressor.compress(chunk):
+            yield out
+    yield compressor.flush()
+
+
+def zstd_stream(chunks, level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    for chunk in _slices(chunks):
+        if out := compressor.compress(chunk):
+            yield out
+    yield compressor.flush()
+
+
+def compress_response(response, accept_encodings, config):
+    """Compress `response` in place if the client accepts it.
+
+    Only listing-like payloads (JSON, XML) above
+    CTADS_COMPRESSION_MIN_SIZE are compressed; file bodies are sent
+    as they are.
+    """
+    if response.mimetype not in compressible_mimetypes or \
+            'Content-Encoding' in response.headers or \
+            'Content-Range' in response.headers or \
+            response.status_code < 200 or \
+            response.status_code in [204, 206, 304]:
+        return response
+
+    if not response.is_streamed and \
+            response.content_length is not None and \
+            response.content_length < config['CTADS_COMPRESSION_MIN_SIZE']:
+        return response
+
+    encoding = accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if encoding == 'zstd':
+        stream = zstd_stream(response.response,
+                             config['CTADS_COMPRESSION_ZSTD_LEVEL'])
+    else:
+        stream = gzip_stream(response.response,
+                             config['CTADS_COMPRESSION_GZIP_LEVEL'])
+
+    logger.debug('compressing %s response with %s',
+                 response.mimetype, encoding)
+
+    response.response = stream
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    response.vary.add('Accept-Encoding')
+
+    return response
@@ -0,0 +1,68 @@
+import io
+import re
+import xml.etree.ElementTree as ET
+from email.utils import parsedate_to_datetime
+
+
+def _prop(response, tag):
+    # the last non-empty value, properties which are not found upstream are
+    # reported empty in a separate propstat
+    value = None
+    for element in response.iter(tag):
+        if element.text:
+            value = element.text
+    return value
+
+
+def iter_multistatus(content):
+    """Iterate over the responses of a PROPFIND multistatus body.
+
+    Yields (href, size, mtime) tuples, with size as an int and mtime as a
+    POSIX timestamp, or None when the property is missing. The body is
+    parsed incrementally and each response is discarded once yielded.
+    """
+    for _, element in ET.iterparse(io.BytesIO(content)):
+        if element.tag != '{DAV:}response':
+            continue
+
+        size = _prop(element, '{DAV:}getcontentlength')
+        yield (
+            _prop(element, '{DAV:}href'),
+            None if size is None else int(size),
+            parse_http_date(_prop(element, '{DAV:}getlastmodified')),
+        )
+        element.clear()
+
+
+def strip_basepath(href, basepath):
+    return re.sub('^/*'+basepath+'/', '', href)
+
+
+def parse_http_date(value):
+    """Convert a getlastmodified value to a POSIX timestamp."""
+    if value is None:
+        return None
+    return parsedate_to_datetime(value).timestamp()
+
+
+def parse_digest(value):
+    """Parse an RFC 3230 Digest header into a dict of algorithm: digest."""
+    digests = {}
+    for item in (value or '').split(','):
+        algorithm, sep, digest = item.strip().partition('=')
+        if sep:
+            digests[algorithm.lower()] = digest
+    return digests
+
+
+def digests_match(digests, other):
+    """Whether two parsed Digest headers agree on a common algorithm.
+
+    adler32 is hexadecimal and compared regardless of case, other algorithms
+    (md5, sha-256) are base64 encoded.
+    """
+    common = set(digests) & set(other)
+    return bool(common) and all(
+        digests[a].lower() == other[a].lower() if a == 'adler32'
+        else digests[a] == other[a]
+        for a in common)
@@ -0,0 +1,280 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import logging
+import sqlite3
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from downloadservice.dav import iter_multistatus, strip_basepath
+
+logger = logging.getLogger(__name__)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    cert_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+CREATE INDEX IF NOT EXISTS entries_mtime ON entries (mtime);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    listed_at REAL NOT NULL
+);
+'''
+
+# trigram index of the paths, for globs not anchored at the start, kept in
+# sync with `entries` by triggers; needs SQLite >= 3.34 built with FTS5
+trigram_schema = '''
+CREATE VIRTUAL TABLE entry_paths USING fts5(
+    path, content='entries', tokenize='trigram case_sensitive 1');
+CREATE TRIGGER entries_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entry_paths (rowid, path) VALUES (new.rowid, new.path);
+END;
+CREATE TRIGGER entries_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entry_paths (entry_paths, rowid, path)
+        VALUES ('delete', old.rowid, old.path);
+END;
+INSERT INTO entry_paths (entry_paths) VALUES ('rebuild');
+'''
+
+
+class MetadataIndex:
+    """SQLite store of the path, size and mtime of upstream entries.
+
+    Directory paths end with '/', as the hrefs returned by /list.
+    """
+
+    def __init__(self, path, cert_key_from_path):
+        self.cert_key_from_path = cert_key_from_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # rows replaced by INSERT OR REPLACE also leave the trigram index
+            self._conn.execute('PRAGMA recursive_triggers=ON')
+            self._conn.executescript(schema)
+            self.trigrams = self._create_trigram_index()
+
+    def _create_trigram_index(self):
+        if self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'entry_paths'"
+                ).fetchone():
+            return True
+        try:
+            self._conn.executescript(
+                'BEGIN; ' + trigram_schema + ' COMMIT;')
+        except sqlite3.OperationalError as e:
+            self._conn.rollback()
+            logger.warning('SQLite trigram index not available, globs '
+                           'starting with a wildcard scan the index: %s', e)
+            return False
+        return True
+
+    def directory_mtime(self, path):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT mtime FROM directories WHERE path = ?',
+                (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def subdirectories(self, path):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM entries WHERE parent = ? "
+                "AND type = 'directory'", (path,)).fetchall()
+        return [row[0] for row in rows]
+
+    def _remove_tree(self, path):
+        for table in ['entries', 'directories']:
+            self._conn.execute(
+                f'DELETE FROM {table} WHERE substr(path, 1, ?) = ?',
+                (len(path), path))
+
+    def remove_tree(self, path):
+        with self._lock, self._conn:
+            self._remove_tree(path)
+
+    def replace_directory(self, path, mtime, entries):
+        """Replace the content of directory `path` by `entries`.
+
+        Entries are dicts with `href`, `type`, `size` and `mtime`.
+        Subdirectories which disappeared are removed with their content.
+        """
+        hrefs = set(entry['href'] for entry in entries)
+        with self._lock, self._conn:
+            for (old,) in self._conn.execute(
+                    'SELECT path FROM entries WHERE parent = ?',
+                    (path,)).fetchall():
+                if old not in hrefs:
+                    self._remove_tree(old)
+
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO entries '
+                '(path, parent, type, size, mtime, cert_key) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(entry['href'], path, entry['type'], entry['size'],
+                  entry['mtime'], self.cert_key_from_path(entry['href']))
+                 for entry in entries])
+            self._conn.execute(
+                'INSERT OR REPLACE INTO directories (path, mtime, listed_at) '
+                'VALUES (?, ?, ?)', (path, mtime, time.time()))
+
+    def search(self, cert_keys, glob=None, type=None, size_min=None,
+               size_max=None, mtime_min=None, mtime_max=None, limit=1000):
+        """Entries matching all the given filters, sorted by path.
+
+        `glob` uses SQLite GLOB semantics on the full path: `*` also matches
+        `/`. Only entries whose cert key is in `cert_keys` are returned.
+        """
+        conditions = ['cert_key IN (%s)' % ','.join('?' * len(cert_keys))]
+        params = list(cert_keys)
+        if glob is not None and self.trigrams and glob[:1] in '*?[':
+            # the primary key only serves globs with a literal prefix
+            conditions.append(
+                'rowid IN (SELECT rowid FROM entry_paths WHERE path GLOB ?)')
+            params.append(glob)
+        for condition, value in [
+                ('path GLOB ?', glob),
+                ('type = ?', type),
+                ('size >= ?', size_min),
+                ('size <= ?', size_max),
+                ('mtime >= ?', mtime_min),
+                ('mtime <= ?', mtime_max)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT path, type, size, mtime FROM entries WHERE ' +
+                ' AND '.join(conditions) + ' ORDER BY path LIMIT ?',
+                params + [limit]).fetchall()
+
+        return [dict(href=path, type=type, size=size, mtime=mtime)
+                for path, type, size, mtime in rows]
+
+
+class Indexer:
+    """Crawl upstream folders into a MetadataIndex.
+
+    Directories are listed with pooled, concurrent PROPFINDs. A directory
+    whose mtime did not change since it was last listed is not listed
+    again: only its known subdirectories are checked, with a Depth 0
+    PROPFIND.
+    """
+
+    def __init__(self, index, upstream_request, base_path, folders,
+                 session_factory, concurrency=8, interval=3600):
+        self.index = index
+        self.upstream_request = upstream_request
+        self.base_path = base_path
+        self.folders = folders
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.interval = interval
+
+        self.stats = dict(crawls=0, listings=0, checks=0, errors=0,
+                          last_crawl_started=None, last_crawl_finished=None)
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _propfind(self, session, path, depth):
+        return self.upstream_request(
+            session, 'PROPFIND', path, headers={'Depth': str(depth)})
+
+    def _entries(self, content):
+        entries = []
+        for href, size, mtime in iter_multistatus(content):
+            href = strip_basepath(href, self.base_path)
+            entries.append(dict(
+                href=href,
+                type='directory' if href.endswith('/') else 'file',
+                size=size,
+                mtime=mtime))
+        return entries
+
+    def _visit(self, session, path, mtime):
+        """Index directory `path`, return the subdirectories to visit."""
+        if mtime is None:
+            r = self._propfind(session, path, 0)
+            self.stats['checks'] += 1
+            if r.status_code == 404:
+                self.index.remove_tree(path)
+                return []
+            r.raise_for_status()
+            mtime = self._entries(r.content)[0]['mtime']
+
+        if mtime is not None and mtime == self.index.directory_mtime(path):
+            return [(subdir, None)
+                    for subdir in self.index.subdirectories(path)]
+
+        r = self._propfind(session, path, 1)
+        self.stats['listings'] += 1
+        if r.status_code == 404:
+            self.index.remove_tree(path)
+            return []
+        r.raise_for_status()
+
+        entries = [entry for entry in self._entries(r.content)
+                   if entry['href'] != path]
+        self.index.replace_directory(path, mtime, entries)
+
+        return [(entry['href'], entry['mtime']) for entry in entries
+                if entry['type'] == 'directory']
+
+    def crawl_once(self):
+        self.stats['last_crawl_started'] = time.time()
+
+        for folder in self.folders:
+            root = folder.strip('/') + '/'
+            logger.info('indexing %s', root)
+
+            with self.session_factory(root) as session:
+                adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                with ThreadPoolExecutor(self.concurrency) as pool:
+                    pending = {pool.submit(self._visit, session, root, None)}
+                    while pending and not self._stop.is_set():
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            try:
+                                subdirs = future.result()
+                            except Exception as e:
+                                logger.error('error while indexing: %s', e)
+                                self.stats['errors'] += 1
+                                continue
+                            for subdir, mtime in subdirs:
+                                pending.add(pool.submit(
+                                    self._visit, session, subdir, mtime))
+
+        self.stats['crawls'] += 1
+        self.stats['last_crawl_finished'] = time.time()
+        logger.info('indexing done: %s', self.stats)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.crawl_once()
+            except Exception as e:
+                logger.error('indexing failed: %s', e)
+                self.stats['errors'] += 1
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,232 @@
+from collections import deque
+import statistics
+import threading
+import time
+
+from downloadservice.limits import LimitExceeded
+
+# webdav methods streaming file content
+bulk_webdav_methods = ['GET', 'PUT']
+
+# probes answered whatever the load, so that a busy worker is not taken
+# out of rotation by its load balancer
+exempt_routes = ['health', 'storage-status']
+
+
+def route_of(path):
+    return path.strip('/').split('/', 1)[0]
+
+
+def classify(method, path):
+    """Lane of a request: 'bulk' for file transfers, 'interactive' for
+    metadata requests. `path` is relative to the url prefix."""
+    route = route_of(path)
+    if route in ['fetch', 'upload', 'upload-tar']:
+        return 'interactive' if method == 'HEAD' else 'bulk'
+    if route == 'webdav' and method in bulk_webdav_methods:
+        return 'bulk'
+    return 'interactive'
+
+
+class Lane:
+    """Requests of one class, at most `capacity` running and `queue_size`
+    waiting, 0 is unlimited."""
+
+    def __init__(self, name, capacity, queue_size, borrows=False,
+                 history_size=1000):
+        self.name = name
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.borrows = borrows
+
+        # requests running in a slot of this lane, whatever their lane
+        self.used = 0
+        self.running = 0
+        self.borrowed = 0
+        self.waiting = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waits = deque(maxlen=history_size)
+
+    def has_slot(self):
+        return self.capacity <= 0 or self.used < self.capacity
+
+    def stats(self):
+        waits = sorted(self.waits)
+        wait = dict(mean=statistics.fmean(waits) if waits else 0,
+                    max=waits[-1] if waits else 0)
+        if len(waits) > 1:
+            q = statistics.quantiles(waits, n=100, method='inclusive')
+            wait.update(p50=q[49], p90=q[89], p99=q[98])
+        return dict(capacity=self.capacity, queue_size=self.queue_size,
+                    running=self.running, used=self.used,
+                    borrowed=self.borrowed, waiting=len(self.waiting),
+                    admitted=self.admitted, rejected=self.rejected,
+                    timed_out=self.timed_out, wait=wait)
+
+
+class LaneScheduler:
+    """Admission of requests into lanes ordered by priority.
+
+    A lane which `borrows` also runs requests in free slots of the lanes
+    after it, and its waiting requests are admitted before theirs when a
+    slot frees; within a lane, requests are admitted in order. A request
+    beyond the queue of its lane, or waiting longer than `queue_timeout`,
+    is refused with LimitExceeded.
+    """
+
+    def __init__(self, lanes, queue_timeout=30, retry_after=5):
+        self.lanes = lanes
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+
+    def lane(self, name):
+        return next(lane for lane in self.lanes if lane.name == name)
+
+    def threads(self):
+        """Server threads needed for all running and waiting requests, None
+        when a lane is unlimited."""
+        if any(lane.capacity <= 0 or lane.queue_size <= 0
+               for lane in self.lanes):
+            return None
+        return sum(lane.capacity + lane.queue_size for lane in self.lanes)
+
+    def _slot(self, lane, ticket):
+        """Lane whose slot the request can take now, with the lock held."""
+        if lane.waiting and lane.waiting[0] is not ticket:
+            return None
+
+        n = self.lanes.index(lane)
+        pools = self.lanes[n:] if lane.borrows else [lane]
+        for pool in pools:
+            if not pool.has_slot():
+                continue
+            # waiting requests of lanes before can also take this slot
+            if any(other.waiting and (other is pool or other.borrows)
+                   for other in self.lanes[:n]):
+                continue
+            return pool
+        return None
+
+    def acquire(self, name):
+        """Wait for a slot in lane `name`; returns the lane of the slot,
+        to be released."""
+        lane = self.lane(name)
+        ticket = object()
+        with self._cond:
+            pool = self._slot(lane, ticket)
+            if pool is None:
+                if 0 < lane.queue_size <= len(lane.waiting):
+                    lane.rejected += 1
+                    raise LimitExceeded(
+                        f'Too many {lane.name} requests queued, at most '
+                        f'{lane.queue_size} are allowed', self.retry_after)
+
+                started = time.monotonic()
+                deadline = started + self.queue_timeout
+                lane.waiting.append(ticket)
+                try:
+                    while pool is None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            lane.timed_out += 1
+                            raise LimitExceeded(
+                                f'Timed out waiting for a slot for '
+                                f'{lane.name} requests', self.retry_after)
+                        self._cond.wait(remaining)
+                        pool = self._slot(lane, ticket)
+                finally:
+                    lane.waiting.remove(ticket)
+                    # the next request of the lane may now proceed
+                    self._cond.notify_all()
+                lane.waits.append(time.monotonic() - started)
+            else:
+                lane.waits.append(0)
+
+            pool.used += 1
+            lane.running += 1
+            lane.admitted += 1
+            if pool is not lane:
+                pool.borrowed += 1
+            return pool
+
+    def release(self, name, pool):
+        lane = self.lane(name)
+        with self._cond:
+            pool.used -= 1
+            lane.running -= 1
+            if pool is not lane:
+                pool.borrowed -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {lane.name: lane.stats() for lane in self.lanes}
+
+
+class LaneAdmission:
+    """WSGI middleware running each request in its lane of the scheduler
+    returned by `get_scheduler()`, when not None, until its response is
+    sent. Requests to `exempt_routes` are not scheduled."""
+
+    def __init__(self, wsgi_app, get_scheduler, url_prefix=''):
+        self.wsgi_app = wsgi_app
+        self.get_scheduler = get_scheduler
+        self.url_prefix = url_prefix
+
+    def __call__(self, environ, start_response):
+        scheduler = self.get_scheduler()
+        if scheduler is None:
+            return self.wsgi_app(environ, start_response)
+
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(self.url_prefix):
+            path = path[len(self.url_prefix):]
+        if route_of(path) in exempt_routes:
+            return self.wsgi_app(environ, start_response)
+
+        name = classify(environ['REQUEST_METHOD'], path)
+        try:
+            pool = scheduler.acquire(name)
+        except LimitExceeded as e:
+            start_response('503 Service Unavailable', [
+                ('Content-Type', 'text/plain'),
+                ('Retry-After', str(e.retry_after))])
+            return [f'Error: {e.message}'.encode()]
+
+        environ['ctads.lane'] = name
+        try:
+            chunks = self.wsgi_app(environ, start_response)
+        except BaseException:
+            scheduler.release(name, pool)
+            raise
+        return ReleasingIterable(
+            chunks, lambda: scheduler.release(name, pool))
+
+
+class ReleasingIterable:
+    """Response body calling `release` once fully sent or closed, even if
+    it was never iterated."""
+
+    def __init__(self, chunks, release):
+        self.chunks = chunks
+        self._release = release
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._release()
+
+    def __iter__(self):
+        yield from self.chunks
+        self.release()
+
+    def close(self):
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            self.release()
@@ -0,0 +1,290 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class LimitExceeded(Exception):
+    def __init__(self, message="too many concurrent transfers",
+                 retry_after=5):
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(self.message)
+
+
+class TokenBucket:
+    """Bandwidth shaping: `rate` bytes per second, with bursts of one
+    second. `consume` blocks the calling thread until the bytes are
+    allowed."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def consume(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Usage:
+    """Streams in progress and bytes transferred for one key."""
+
+    def __init__(self, bandwidth):
+        self.active = 0
+        self.transferred = 0
+        self.bucket = TokenBucket(bandwidth) if bandwidth > 0 else None
+
+    def record(self, n):
+        """Count `n` bytes transferred, waiting for the bandwidth."""
+        self.transferred += n
+        if self.bucket is not None:
+            self.bucket.consume(n)
+
+    def as_dict(self):
+        return dict(active=self.active, transferred=self.transferred)
+
+
+class UsageLimiter:
+    """Concurrent stream and bandwidth limits per key, 0 is unlimited."""
+
+    def __init__(self, name, max_streams=0, bandwidth=0, retry_after=5):
+        self.name = name
+        self.max_streams = max_streams
+        self.bandwidth = bandwidth
+        self.retry_after = retry_after
+        self.usages = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        with self._lock:
+            usage = self.usages.setdefault(key, Usage(self.bandwidth))
+            if 0 < self.max_streams <= usage.active:
+                raise LimitExceeded(
+                    f'Too many concurrent transfers for {self.name} {key}, '
+                    f'at most {self.max_streams} are allowed',
+                    self.retry_after)
+            usage.active += 1
+            return usage
+
+    def release(self, key):
+        with self._lock:
+            self.usages[key].active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {key: usage.as_dict()
+                    for key, usage in self.usages.items()}
+
+
+shared_usage_schema = '''
+CREATE TABLE IF NOT EXISTS transfer_usage (
+    limiter TEXT NOT NULL,
+    key TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    active INTEGER NOT NULL DEFAULT 0,
+    transferred INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (limiter, key, pid)
+)
+'''
+
+
+def _connect_shared(path):
+    # transactions are explicit, BEGIN IMMEDIATE serializes the processes
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=10,
+                           isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(shared_usage_schema)
+    return conn
+
+
+class SharedUsage(Usage):
+    """Usage of one key in this process, synchronised with the other
+    processes at most every `sync_interval` seconds."""
+
+    def __init__(self, limiter, key, sync_interval):
+        super().__init__(limiter.bandwidth)
+        self.limiter = limiter
+        self.key = key
+        self.sync_interval = sync_interval
+        # bytes not yet added to the shared count
+        self.pending = 0
+        self.synced = time.monotonic()
+
+    def record(self, n):
+        with self.limiter._lock:
+            self.pending += n
+            due = time.monotonic() - self.synced >= self.sync_interval
+        if due:
+            self.limiter.sync(self.key)
+        super().record(n)
+
+
+class SharedUsageLimiter(UsageLimiter):
+    """UsageLimiter counting the streams of all the processes sharing the
+    SQLite file `path`.
+
+    Streams are counted per process, so that those of a process which
+    exited are dropped with `forget_process()`. The bandwidth of a key is
+    split between the processes in proportion to their streams, as last
+    synchronised.
+    """
+
+    def __init__(self, path, name, max_streams=0, bandwidth=0,
+                 retry_after=5, sync_interval=1):
+        super().__init__(name, max_streams, bandwidth, retry_after)
+        self.sync_interval = sync_interval
+        self.pid = os.getpid()
+        self._conn = _connect_shared(path)
+
+    def acquire(self, key):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                total, = self._conn.execute(
+                    'SELECT coalesce(sum(active), 0) FROM transfer_usage '
+                    'WHERE limiter = ? AND key = ?',
+                    (self.name, key)).fetchone()
+                if 0 < self.max_streams <= total:
+                    raise LimitExceeded(
+                        f'Too many concurrent transfers for {self.name} '
+                        f'{key}, at most {self.max_streams} are allowed',
+                        self.retry_after)
+                self._conn.execute(
+                    'INSERT INTO transfer_usage (limiter, key, pid, active) '
+                    'VALUES (?, ?, ?, 1) ON CONFLICT (limiter, key, pid) '
+                    'DO UPDATE SET active = active + 1',
+                    (self.name, key, self.pid))
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+            usage = self.usages.get(key)
+            if usage is None:
+                usage = self.usages[key] = SharedUsage(
+                    self, key, self.sync_interval)
+            usage.active += 1
+        self.sync(key)
+        return usage
+
+    def release(self, key):
+        with self._lock:
+            self.usages[key].active -= 1
+            self._conn.execute(
+                'UPDATE transfer_usage SET active = active - 1 '
+                'WHERE limiter = ? AND key = ? AND pid = ?',
+                (self.name, key, self.pid))
+        self.sync(key)
+
+    def sync(self, key):
+        """Record the bytes transferred for `key` and update the share of
+        its bandwidth."""
+        with self._lock:
+            usage = self.usages[key]
+            pending, usage.pending = usage.pending, 0
+            usage.synced = time.monotonic()
+            if pending:
+                self._conn.execute(
+                    'UPDATE transfer_usage SET transferred = transferred + ? '
+                    'WHERE limiter = ? AND key = ? AND pid = ?',
+                    (pending, self.name, key, self.pid))
+            total, = self._conn.execute(
+                'SELECT coalesce(sum(active), 0) FROM transfer_usage '
+                'WHERE limiter = ? AND key = ?',
+                (self.name, key)).fetchone()
+            if usage.bucket is not None and usage.active > 0:
+                usage.bucket.set_rate(
+                    self.bandwidth * usage.active / max(total, usage.active))
+
+    def stats(self):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, sum(active), sum(transferred) '
+                'FROM transfer_usage WHERE limiter = ? GROUP BY key',
+                (self.name,)).fetchall()
+            stats = {key: dict(active=active, transferred=transferred)
+                     for key, active, transferred in rows}
+            for key, usage in self.usages.items():
+                if key in stats:
+                    stats[key]['transferred'] += usage.pending
+            return stats
+
+    @staticmethod
+    def forget_process(path, pid=None):
+        """Drop the streams of process `pid`, or of all processes, keeping
+        their transferred bytes."""
+        conn = _connect_shared(path)
+        try:
+            where, params = ('WHERE pid = ?', (pid,)) if pid is not None \
+                else ('WHERE pid != 0', ())
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT INTO transfer_usage (limiter, key, pid, transferred) '
+                'SELECT limiter, key, 0, transferred FROM transfer_usage ' +
+                where + ' ON CONFLICT (limiter, key, pid) '
+                'DO UPDATE SET transferred = transferred + '
+                'excluded.transferred', params)
+            conn.execute('DELETE FROM transfer_usage ' + where, params)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+
+class Slot:
+    """Admission of one transfer, to be released when it is done."""
+
+    def __init__(self, limiters, keys):
+        self.acquired = []
+        try:
+            for limiter, key in zip(limiters, keys):
+                self.acquired.append(
+                    (limiter, key, limiter.acquire(key)))
+        except LimitExceeded:
+            self.release()
+            raise
+
+    def throttle(self, n):
+        for _, _, usage in self.acquired:
+            usage.record(n)
+
+    def release(self):
+        while self.acquired:
+            limiter, key, _ = self.acquired.pop()
+            limiter.release(key)
+
+
+class ThrottledStream:
+    """File-like wrapper shaping reads with `throttle(n)`."""
+
+    def __init__(self, stream, throttle):
+        self.stream = stream
+        self.throttle = throttle
+
+    def read(self, *args):
+        buf = self.stream.read(*args)
+        self.throttle(len(buf))
+        return buf
+
+
+def throttled(chunks, slot):
+    """Iterate over `chunks`, shaped by `slot`, releasing it at the end."""
+    try:
+        for chunk in chunks:
+            slot.throttle(len(chunk))
+            yield chunk
+    finally:
+        slot.release()
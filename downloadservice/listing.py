@@ -0,0 +1,170 @@
+from datetime import datetime
+import fnmatch
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError:
+    logger.info('msgpack not available, msgpack listings disabled')
+    msgpack = None
+
+fields = ['href', 'url', 'size', 'mtime', 'type']
+sort_keys = ['href', 'size', 'mtime', 'type']
+
+format_mimetypes = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/json',
+    'msgpack': 'application/msgpack',
+}
+
+
+def parse_time_arg(value):
+    """POSIX timestamp from a timestamp or an ISO 8601 date argument."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def entry_name(href):
+    return href.rstrip('/').rsplit('/', 1)[-1]
+
+
+def entry_type(href):
+    return 'directory' if href.endswith('/') else 'file'
+
+
+class ListingQuery:
+    """Filters, sort order and projection of a /list request.
+
+    `match` is meant to be called on the raw PROPFIND values, before an entry
+    is built, so that filtered out entries cost as little as possible.
+    """
+
+    def __init__(self, glob=None, regex=None, type=None,
+                 size_min=None, size_max=None, mtime_min=None, mtime_max=None,
+                 sort=None, fields=None, format='json'):
+        self.glob = glob
+        self.regex = regex
+        self.type = type
+        self.size_min = size_min
+        self.size_max = size_max
+        self.mtime_min = mtime_min
+        self.mtime_max = mtime_max
+        self.sort = sort or []
+        self.fields = fields
+        self.format = format
+
+    @classmethod
+    def from_args(cls, args):
+        """Build the query from request arguments, raise ValueError if
+        an argument is invalid."""
+        query = cls(glob=args.get('glob'))
+
+        if (regex := args.get('regex')) is not None:
+            try:
+                query.regex = re.compile(regex)
+            except re.error as e:
+                raise ValueError(f'regex: {e}')
+
+        if (type := args.get('type')) is not None:
+            if type not in ['file', 'directory']:
+                raise ValueError(f'type: {type}')
+            query.type = type
+
+        for name, arg_type in [('size_min', int), ('size_max', int),
+                               ('mtime_min', parse_time_arg),
+                               ('mtime_max', parse_time_arg)]:
+            if (value := args.get(name)) is not None:
+                setattr(query, name, arg_type(value))
+
+        if (sort := args.get('sort')) is not None:
+            for key in sort.split(','):
+                if key.lstrip('-') not in sort_keys:
+                    raise ValueError(f'sort: {key}')
+                query.sort.append(key)
+
+        if (projection := args.get('fields')) is not None:
+            query.fields = projection.split(',')
+            for field in query.fields:
+                if field not in fields:
+                    raise ValueError(f'fields: {field}')
+
+        if (format := args.get('format')) is not None:
+            if format not in format_mimetypes:
+                raise ValueError(f'format: {format}')
+            if format == 'msgpack' and msgpack is None:
+                raise ValueError('format: msgpack is not available')
+            query.format = format
+
+        return query
+
+    def match(self, href, size, mtime):
+        if self.type is not None and entry_type(href) != self.type:
+            return False
+        if self.glob is not None and \
+                not fnmatch.fnmatchcase(entry_name(href), self.glob):
+            return False
+        if self.regex is not None and \
+                self.regex.search(entry_name(href)) is None:
+            return False
+        for value, low, high in [(size, self.size_min, self.size_max),
+                                 (mtime, self.mtime_min, self.mtime_max)]:
+            if low is None and high is None:
+                continue
+            if value is None or \
+                    (low is not None and value < low) or \
+                    (high is not None and value > high):
+                return False
+        return True
+
+    def sorted(self, entries):
+        # stable sorts, from the least to the most significant key; missing
+        # values always come last
+        for key in reversed(self.sort):
+            name = key.lstrip('-')
+            reverse = key.startswith('-')
+            present = [e for e in entries if e.get(name) is not None]
+            missing = [e for e in entries if e.get(name) is None]
+            entries = sorted(present, key=lambda e: e[name],
+                             reverse=reverse) + missing
+        return entries
+
+    def project(self, entry):
+        if self.fields is None:
+            return entry
+        return {k: v for k, v in entry.items() if k in self.fields}
+
+    def columns(self, entries, url_prefix):
+        """Entries as parallel arrays, with missing values as None.
+
+        The `url` of every entry is `url_prefix` followed by its `href`, so
+        only the prefix is sent.
+        """
+        names = [f for f in self.fields or fields if f != 'url']
+        if 'url' in (self.fields or fields) and 'href' not in names:
+            names.insert(0, 'href')
+
+        return dict(
+            url_prefix=url_prefix,
+            count=len(entries),
+            columns={name: [e.get(name) for e in entries] for name in names},
+        )
+
+    def render(self, entries, url_prefix):
+        """Body and mimetype of the listing in one of the formats other
+        than json."""
+        mimetype = format_mimetypes[self.format]
+        if self.format == 'ndjson':
+            body = ''.join(json.dumps(self.project(e)) + '\n'
+                           for e in entries)
+        elif self.format == 'columnar':
+            body = json.dumps(self.columns(entries, url_prefix))
+        else:
+            body = msgpack.packb(self.columns(entries, url_prefix))
+        return body, mimetype
@@ -0,0 +1,117 @@
+from collections import deque
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StorageProber:
+    """Periodically check the upstream storage in a background thread.
+
+    `probe(session)` returns a (healthy, message) tuple. The upstream session,
+    and with it the credentials and the connection, is reused between probes
+    and renewed every `credential_max_age` seconds or after a failure.
+    `on_status(status)` is called with the status after each probe.
+    """
+
+    def __init__(self, session_factory, probe, interval=30,
+                 credential_max_age=3600, history_size=20, on_status=None):
+        self.session_factory = session_factory
+        self.probe = probe
+        self.interval = interval
+        self.credential_max_age = credential_max_age
+        self.on_status = on_status
+
+        self.healthy = None
+        self.message = 'Storage has not been checked yet'
+        self.checked_at = None
+        self.last_success = None
+        self.history = deque(maxlen=history_size)
+
+        self._context = None
+        self._session = None
+        self._session_created = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _close_session(self):
+        if self._context is not None:
+            try:
+                self._context.__exit__(None, None, None)
+            except Exception as e:
+                logger.warning('error while closing probe session: %s', e)
+        self._context = None
+        self._session = None
+
+    def _get_session(self):
+        if self._session is not None and \
+                time.time() - self._session_created < \
+                self.credential_max_age:
+            return self._session
+
+        self._close_session()
+        context = self.session_factory()
+        self._session = context.__enter__()
+        self._context = context
+        self._session_created = time.time()
+        return self._session
+
+    def probe_once(self):
+        started = time.time()
+        try:
+            healthy, message = self.probe(self._get_session())
+        except Exception as e:
+            logger.error('storage probe failed: %s', e)
+            healthy, message = False, f'Unhealthy! - {e}'
+            self._close_session()
+        latency = time.time() - started
+
+        with self._lock:
+            self.healthy = healthy
+            self.message = message
+            self.checked_at = time.time()
+            if healthy:
+                self.last_success = self.checked_at
+            self.history.append(dict(
+                checked_at=self.checked_at, healthy=healthy, latency=latency))
+
+        if not healthy:
+            logger.error('storage is unhealthy: %s', message)
+        if self.on_status is not None:
+            self.on_status(self.status())
+
+    def status(self):
+        """Latest result; considered unhealthy when it is too old, and
+        unknown (None) when periodic probing is disabled."""
+        with self._lock:
+            if self.interval <= 0:
+                healthy, message = None, 'Storage probing is disabled'
+            else:
+                stale = self.checked_at is None or \
+                    time.time() - self.checked_at > 3 * self.interval
+                healthy = bool(self.healthy) and not stale
+                message = self.message
+            return dict(
+                healthy=healthy,
+                message=message,
+                checked_at=self.checked_at,
+                last_success=self.last_success,
+                history=list(self.history),
+            )
+
+    def _run(self):
+        while True:
+            self.probe_once()
+            if self._stop.wait(self.interval):
+                break
+        self._close_session()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
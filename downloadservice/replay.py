@@ -0,0 +1,272 @@
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from downloadservice.traffic import name_suffix
+
+logger = logging.getLogger(__name__)
+
+# paths of the routes without a path argument
+route_paths = {
+    'health': '/health',
+    'storage_status': '/storage-status',
+    'upstream_status': '/upstream-status',
+    'lane_status': '/lane-status',
+    'usage': '/usage',
+    'search': '/search',
+}
+
+webdav_replayed_methods = ['GET', 'HEAD', 'OPTIONS', 'PROPFIND', 'PUT',
+                           'MKCOL']
+
+
+def load_trace(path):
+    """Records of a trace file written by TrafficRecorder, in time order."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda r: r['t'])
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def rank(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return dict(p50=rank(0.5), p90=rank(0.9), p99=rank(0.99),
+                max=values[-1])
+
+
+def seed(records, root, user='anonymous', upload_folder='lst'):
+    """Create below `root`, the directory served by the storage stand-in,
+    the files and directories read by the trace.
+
+    Files have the largest size downloaded in the trace. Whether a listed
+    path is a file is guessed from its extension.
+    """
+    dirs = set()
+    sizes = {}
+    for record in records:
+        path = (record['p'] or '').replace('{user}', user)
+        route, method = record['r'], record['m']
+        if route in ['upload', 'upload_tar']:
+            dirs.add(os.path.dirname(
+                '/'.join([upload_folder, 'users', user, path])))
+        elif not path:
+            continue
+        elif route == 'fetch' or \
+                (route == 'webdav' and method in ['GET', 'HEAD']):
+            size = record['o'] if record['s'] == 200 and method == 'GET' \
+                else 0
+            sizes[path] = max(sizes.get(path, 0), size)
+        elif route in ['list_dir', 'webdav'] and \
+                method in ['GET', 'POST', 'PROPFIND']:
+            if name_suffix(path.rsplit('/', 1)[-1]):
+                sizes.setdefault(path, 0)
+            else:
+                dirs.add(path)
+        elif route == 'webdav' and method in ['PUT', 'MKCOL']:
+            dirs.add(os.path.dirname(path))
+
+    for path in dirs:
+        os.makedirs(os.path.join(root, path), exist_ok=True)
+    for path, size in sizes.items():
+        filename = os.path.join(root, path)
+        if os.path.isdir(filename):
+            continue
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            # the content does not matter, sparse files are quick to create
+            f.truncate(size)
+
+
+def zeros(size, chunk_size=1024**2):
+    while size > 0:
+        n = min(size, chunk_size)
+        yield bytes(n)
+        size -= n
+
+
+def _join(route, path):
+    return route + '/' + path if path else route
+
+
+def build_request(record, user='anonymous'):
+    """Method, path and keyword arguments of requests replaying `record`,
+    None for requests which can not be replayed."""
+    route, method = record['r'], record['m']
+    path = (record['p'] or '').replace('{user}', user)
+    kwargs = dict(params=record.get('q'), headers=record.get('h'))
+
+    if route in route_paths:
+        if method not in ['GET', 'HEAD']:
+            return None
+        return method, route_paths[route], kwargs
+    elif route == 'list_dir':
+        return 'GET', _join('/list', path), kwargs
+    elif route == 'fetch':
+        return 'GET', _join('/fetch', path), kwargs
+    elif route == 'upload':
+        kwargs['data'] = zeros(record['i'])
+        return 'POST', _join('/upload', path), kwargs
+    elif route == 'webdav' and method in webdav_replayed_methods:
+        if method == 'PUT':
+            kwargs['data'] = zeros(record['i'])
+        return method, _join('/webdav', path), kwargs
+    return None
+
+
+def replay(records, url, speed=1.0, concurrency=32, user='anonymous'):
+    """Send the requests of `records` to the service at `url`, `speed`
+    times faster than recorded, or as fast as possible when 0, and return
+    the report.
+
+    Requests are sent on schedule by a pool of `concurrency` threads; the
+    lag measures how late they were sent.
+    """
+    results = []
+    skipped = Counter()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(record, request, due):
+        method, path, kwargs = request
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+
+        started = time.monotonic()
+        received = 0
+        status = None
+        try:
+            with local.session.request(
+                    method, url.rstrip('/') + path, stream=True,
+                    allow_redirects=False, **kwargs) as r:
+                for chunk in r.iter_content(1024**2):
+                    received += len(chunk)
+                status = r.status_code
+        except requests.exceptions.RequestException as e:
+            logger.warning('%s %s failed: %s', method, path, e)
+        with lock:
+            results.append(dict(
+                route=record['r'], status=status,
+                latency=time.monotonic() - started, lag=started - due,
+                received=received, sent=record['i'] if 'data' in kwargs
+                else 0, recorded_latency=record['d']))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for record in records:
+            request = build_request(record, user)
+            if request is None:
+                skipped[f"{record['m']} {record['r']}"] += 1
+                continue
+
+            due = start
+            if speed > 0:
+                due += (record['t'] - records[0]['t']) / speed
+                time.sleep(max(0, due - time.monotonic()))
+            executor.submit(send, record, request, due)
+    duration = time.monotonic() - start
+
+    return make_report(results, skipped, duration)
+
+
+def make_report(results, skipped, duration):
+    def summary(results):
+        return dict(
+            requests=len(results),
+            errors=sum(1 for r in results
+                       if r['status'] is None or r['status'] >= 500),
+            latency=percentiles([r['latency'] for r in results]),
+            recorded_latency=percentiles(
+                [r['recorded_latency'] for r in results]),
+        )
+
+    routes = defaultdict(list)
+    for result in results:
+        routes[result['route']].append(result)
+
+    transferred = sum(r['received'] + r['sent'] for r in results)
+    return dict(
+        summary(results),
+        duration=duration,
+        throughput=len(results) / duration if duration else 0,
+        bytes_per_second=transferred / duration if duration else 0,
+        lag=percentiles([r['lag'] for r in results]),
+        skipped=dict(skipped),
+        routes={route: summary(results)
+                for route, results in sorted(routes.items())},
+    )
+
+
+def format_report(report):
+    lines = [
+        f"{report['requests']} requests in {report['duration']:.1f}s, "
+        f"{report['throughput']:.1f} requests/s, "
+        f"{report['bytes_per_second'] / 1024**2:.1f} MiB/s, "
+        f"{report['errors']} errors, "
+        f"{sum(report['skipped'].values())} skipped",
+        '',
+        f"{'route':<20}{'requests':>10}{'errors':>8}"
+        f"{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'rec p50':>9}"
+        f"{'rec p99':>9}",
+    ]
+    for route, summary in [('all', report)] + \
+            list(report['routes'].items()):
+        latency = summary['latency']
+        recorded = summary['recorded_latency']
+        if not latency:
+            continue
+        lines.append(
+            f"{route:<20}{summary['requests']:>10}{summary['errors']:>8}" +
+            ''.join(f"{latency[q] * 1000:>7.0f}ms"
+                    for q in ['p50', 'p90', 'p99', 'max']) +
+            ''.join(f"{recorded[q] * 1000:>7.0f}ms" for q in ['p50', 'p99']))
+    lines.append(f"send lag p99: {report['lag'].get('p99', 0) * 1000:.0f}ms")
+    return '\n'.join(lines)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description='Replay a traffic capture against a downloadservice')
+    parser.add_argument('trace', help='file of CTADS_TRAFFIC_CAPTURE_PATH')
+    parser.add_argument('--url', required=True,
+                        help='base URL of the downloadservice')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed-up factor, 0 for as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--user', default='anonymous',
+                        help='user name as it appears in the storage paths')
+    parser.add_argument('--seed', metavar='DIR',
+                        help='create the files of the trace in DIR, the '
+                        'directory served by a local storage')
+    parser.add_argument('--upload-folder', default='lst')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    if args.seed:
+        seed(records, args.seed, args.user, args.upload_folder)
+
+    report = replay(records, args.url, args.speed, args.concurrency,
+                    args.user)
+    print(json.dumps(report, indent=2) if args.json
+          else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
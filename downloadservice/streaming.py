@@ -0,0 +1,331 @@
+from collections import deque
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import requests
+import urllib3
+
+logger = logging.getLogger(__name__)
+
+
+class PipelinedReader:
+    """Read a stream in a background thread into a bounded queue.
+
+    Iterating over the reader yields the chunks in order. The queue holds at
+    most `depth` chunks, so a slow consumer applies backpressure to the
+    reading side and memory stays bounded to `depth * chunk_size`.
+
+    `len` is the total expected size, when known; requests uses it to send a
+    sized body instead of chunked transfer-encoding.
+    """
+
+    _eof = object()
+
+    def __init__(self, stream, chunk_size, depth=4, length=None):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.len = length
+        self.total_read = 0
+
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self):
+        try:
+            while not self._closed.is_set():
+                buf = self.stream.read(self.chunk_size)
+                if not buf:
+                    break
+                self.total_read += len(buf)
+                if not self._put(buf):
+                    return
+        except Exception as e:
+            logger.error('error while reading client stream: %s', e)
+            self._put(e)
+            return
+        self._put(self._eof)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._eof:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+
+class ResumeError(Exception):
+    pass
+
+
+class ResumingReader:
+    """Iterate over the body of an upstream GET, resuming after failures.
+
+    When the upstream connection breaks, stalls past the read timeout or
+    ends before Content-Length, the request is sent again by
+    `open_upstream(headers)` with a Range starting at the first byte not yet
+    yielded. The resumed response must carry the same ETag (or
+    Last-Modified), so that a file changed upstream is never spliced from
+    two versions. At most `max_resumes` resumes are attempted.
+    """
+
+    resumable_errors = (requests.exceptions.RequestException,
+                        urllib3.exceptions.HTTPError)
+
+    def __init__(self, response, open_upstream, chunk_size, max_resumes=3,
+                 backoff=1):
+        self.response = response
+        self.open_upstream = open_upstream
+        self.chunk_size = chunk_size
+        self.max_resumes = max_resumes
+        self.backoff = backoff
+
+        self.validator = response.headers.get('ETag') or \
+            response.headers.get('Last-Modified')
+        length = response.headers.get('Content-Length')
+        self.length = None if length is None else int(length)
+        self.sent = 0
+        self.resumes = 0
+
+    def _check_resumed(self, response):
+        validator = response.headers.get('ETag') or \
+            response.headers.get('Last-Modified')
+        if response.status_code != 206 or validator != self.validator:
+            response.close()
+            raise ResumeError(
+                f'unable to resume at byte {self.sent}: upstream returned '
+                f'{response.status_code}, file changed or range unsupported')
+
+    def _resume(self, error):
+        if self.validator is None or self.resumes >= self.max_resumes:
+            raise ResumeError(
+                f'upstream transfer failed at byte {self.sent} after '
+                f'{self.resumes} resumes: {error}')
+
+        self.resumes += 1
+        logger.warning('resuming upstream transfer at byte %s (%s/%s): %s',
+                       self.sent, self.resumes, self.max_resumes, error)
+        time.sleep(self.backoff * self.resumes)
+
+        return self.open_upstream({
+            'Range': f'bytes={self.sent}-',
+            'If-Range': self.validator,
+        })
+
+    def __iter__(self):
+        response = self.response
+        while True:
+            if response is not None:
+                try:
+                    with response:
+                        for chunk in response.iter_content(self.chunk_size):
+                            self.sent += len(chunk)
+                            yield chunk
+
+                    if self.length is None or self.sent >= self.length:
+                        return
+                    error = f'upstream closed after {self.sent} of ' + \
+                        f'{self.length} bytes'
+                except self.resumable_errors as e:
+                    error = str(e)
+
+            try:
+                response = self._resume(error)
+            except self.resumable_errors as e:
+                response = None
+                error = str(e)
+                continue
+            self._check_resumed(response)
+
+
+class ReadAheadPool:
+    """Memory shared by the read-ahead buffers of all transfers.
+
+    A buffer holding nothing is always allowed one chunk, so that every
+    transfer progresses; the total can then exceed `max_size` by at most one
+    chunk per transfer.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.used = 0
+        self.spilled = 0
+        self.peak = 0
+        self.buffers = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, n, holding):
+        with self._lock:
+            if holding and self.used + n > self.max_size:
+                return False
+            self.used += n
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, n):
+        with self._lock:
+            self.used -= n
+
+    def add_spilled(self, n):
+        with self._lock:
+            self.spilled += n
+
+    def add_buffers(self, n):
+        with self._lock:
+            self.buffers += n
+
+    def stats(self):
+        with self._lock:
+            return dict(max_size=self.max_size, used=self.used,
+                        peak=self.peak, spilled=self.spilled,
+                        buffers=self.buffers)
+
+
+class ReadAhead:
+    """Iterate over `chunks`, read in a background thread ahead of the
+    consumer.
+
+    Up to `memory_limit` bytes, within the shared `pool`, are buffered in
+    memory. Beyond that, chunks are written to a temporary file in
+    `spill_dir`, up to `spill_limit` unread bytes, and reading waits only
+    when both are full. The upstream is then read at its own pace, however
+    slow the client is.
+    """
+
+    _poll_interval = 0.1
+
+    def __init__(self, chunks, pool, memory_limit, spill_dir=None,
+                 spill_limit=0):
+        self.chunks = chunks
+        self.pool = pool
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.spill_limit = spill_limit
+
+        self.memory = 0
+        self.spilled = 0
+        self._items = deque()
+        self._spill = None
+        self._spill_offset = 0
+        self._done = False
+        self._error = None
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.pool.add_buffers(1)
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _store(self, chunk):
+        """Buffer `chunk` if there is room, with the lock held."""
+        n = len(chunk)
+        if (self.memory == 0 or self.memory + n <= self.memory_limit) and \
+                self.pool.reserve(n, holding=self.memory > 0):
+            self._items.append(chunk)
+            self.memory += n
+            return True
+
+        if self.spill_dir and self.spilled + n <= self.spill_limit:
+            if self._spill is None:
+                self._spill = tempfile.TemporaryFile(dir=self.spill_dir)
+            os.pwrite(self._spill.fileno(), chunk, self._spill_offset)
+            self._items.append((self._spill_offset, n))
+            self._spill_offset += n
+            self.spilled += n
+            self.pool.add_spilled(n)
+            return True
+
+        return False
+
+    def _read(self):
+        chunks = iter(self.chunks)
+        try:
+            for chunk in chunks:
+                with self._cond:
+                    while not self._closed and not self._store(chunk):
+                        # memory of other transfers is freed without notice
+                        self._cond.wait(self._poll_interval)
+                    if self._closed:
+                        return
+                    self._cond.notify_all()
+        except Exception as e:
+            with self._cond:
+                self._error = e
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+                self._cleanup()
+
+    def _pop(self):
+        """Next buffered chunk, with the lock held."""
+        item = self._items.popleft()
+        if isinstance(item, bytes):
+            self.memory -= len(item)
+            self.pool.release(len(item))
+            return item
+
+        offset, n = item
+        chunk = os.pread(self._spill.fileno(), n, offset)
+        self.spilled -= n
+        self.pool.add_spilled(-n)
+        if self.spilled == 0:
+            # the file is rewritten from the start once read
+            self._spill_offset = 0
+        return chunk
+
+    def __iter__(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._done:
+                    self._cond.wait()
+                if not self._items:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                chunk = self._pop()
+                self._cond.notify_all()
+            yield chunk
+
+    def _cleanup(self):
+        # once both sides are done, with the lock held
+        if not (self._done and self._closed):
+            return
+        while self._items:
+            self._pop()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self.pool.add_buffers(-1)
+
+    def close(self):
+        """Stop reading ahead and free the buffers; the reading thread
+        exits once its current read returns."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            self._cleanup()
@@ -0,0 +1,206 @@
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+# extensions, like .fits.fz, are kept in anonymised names
+_suffix = re.compile(r'(\.[A-Za-z0-9]{1,8}){1,2}$')
+
+# query arguments read by the routes whose short values are recorded;
+# names in `glob` or `regex` are not
+recorded_args = ['mode', 'format', 'type', 'sort', 'fields', 'chunk_size',
+                 'limit']
+recorded_headers = ['Depth', 'Range', 'Accept-Encoding']
+
+
+def name_suffix(name):
+    """Extension of `name`, like .fits.fz, empty when it has none."""
+    m = _suffix.search(name)
+    return m.group(0) if m and m.start() > 0 else ''
+
+
+def anonymise_path(path, key, keep_top=True):
+    """Shape of `path`: each name replaced by a keyed hash keeping its
+    extension, so that the same name always gives the same token.
+
+    The top level storage folder, when `keep_top`, and `users` are kept, and
+    the user directory below `users` becomes `{user}`.
+    """
+    if not path:
+        return path
+
+    names = path.strip('/').split('/')
+    shape = []
+    for n, name in enumerate(names):
+        if (n == 0 and keep_top) or name == 'users':
+            shape.append(name)
+        elif n > 0 and names[n - 1] == 'users':
+            shape.append('{user}')
+        else:
+            token = hmac.new(key, name.encode(), hashlib.sha256).hexdigest()
+            shape.append(token[:10] + name_suffix(name))
+    return '/'.join(shape)
+
+
+class TrafficRecorder:
+    """Append anonymised request records to `path`, one JSON object per
+    line, gzipped when the name ends in .gz.
+
+    Records are buffered and appended every `flush_interval` seconds, each
+    flush as a single write (a gzip member), so that worker processes can
+    share the file.
+    """
+
+    def __init__(self, path, key, sample_rate=1.0, flush_interval=1,
+                 buffer_size=1000):
+        self.path = path
+        self.key = key
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.recorded = 0
+        self._buffer = []
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(self, method, route, path, args, headers, received, sent,
+               status, started, duration):
+        keep_top = route not in ['upload', 'upload_tar']
+        entry = dict(
+            t=round(started, 3),
+            m=method,
+            r=route,
+            p=anonymise_path(path, self.key, keep_top),
+            i=received,
+            o=sent,
+            s=status,
+            d=round(duration, 4),
+        )
+        query = {k: v for k, v in args.items()
+                 if k in recorded_args and len(v) <= 16}
+        if query:
+            entry['q'] = query
+        if headers:
+            entry['h'] = headers
+
+        with self._lock:
+            self._buffer.append(json.dumps(entry, separators=(',', ':')))
+            self.recorded += 1
+            due = len(self._buffer) >= self.buffer_size or \
+                time.monotonic() - self._flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+            self._flushed = time.monotonic()
+            if not lines:
+                return
+
+            data = ('\n'.join(lines) + '\n').encode()
+            if self.path.endswith('.gz'):
+                data = gzip.compress(data)
+            try:
+                fd = os.open(self.path,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.error('unable to write traffic records: %s', e)
+
+
+class CountingInput:
+    """Request body counting the bytes read by the application."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, *args):
+        buf = self.stream.read(*args)
+        self.count += len(buf)
+        return buf
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self.count += len(line)
+        return line
+
+    def __iter__(self):
+        for line in self.stream:
+            self.count += len(line)
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class TrafficCapture:
+    """WSGI middleware recording every request with the recorder returned
+    by `get_recorder()`, when not None.
+
+    The duration runs until the response body is fully sent. The route and
+    its arguments are set in the environ by the application, as
+    `ctads.route` and `ctads.path`.
+    """
+
+    def __init__(self, wsgi_app, get_recorder):
+        self.wsgi_app = wsgi_app
+        self.get_recorder = get_recorder
+
+    def __call__(self, environ, start_response):
+        recorder = self.get_recorder()
+        if recorder is None or not recorder.sampled():
+            return self.wsgi_app(environ, start_response)
+        return self._recorded(recorder, environ, start_response)
+
+    def _recorded(self, recorder, environ, start_response):
+        started = time.time()
+        t0 = time.monotonic()
+        body = environ['wsgi.input'] = CountingInput(environ['wsgi.input'])
+        response = {}
+
+        def recording_start_response(status, headers, *args):
+            response['status'] = int(status.split()[0])
+            return start_response(status, headers, *args)
+
+        chunks = self.wsgi_app(environ, recording_start_response)
+        sent = 0
+        try:
+            for chunk in chunks:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            headers = {}
+            for name in recorded_headers:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                if key in environ:
+                    headers[name] = environ[key]
+            recorder.record(
+                environ['REQUEST_METHOD'],
+                environ.get('ctads.route'),
+                environ.get('ctads.path'),
+                dict(parse_qsl(environ.get('QUERY_STRING', ''))),
+                headers,
+                body.count or int(environ.get('CONTENT_LENGTH') or 0),
+                sent, response.get('status'), started,
+                time.monotonic() - t0)
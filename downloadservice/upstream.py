@@ -0,0 +1,278 @@
+import logging
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from downloadservice.probe import StorageProber
+
+logger = logging.getLogger(__name__)
+
+idempotent_methods = ['GET', 'HEAD', 'OPTIONS', 'PROPFIND']
+
+# statuses for which another endpoint is tried, when possible
+failover_statuses = [502, 503, 504]
+
+
+def bounded_timeout(timeout, remaining):
+    """requests timeout, (connect, read) or a single value, with each part
+    at most `remaining` seconds."""
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining)
+                     for t in timeout)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def read_within(response, deadline):
+    """Read the body of a streamed response, failing past `deadline`."""
+    chunks = []
+    for chunk in response.iter_content(64 * 1024):
+        chunks.append(chunk)
+        if time.monotonic() > deadline:
+            response.close()
+            raise requests.exceptions.ReadTimeout(
+                'total timeout exceeded while reading the response')
+    # as Response.content does
+    response._content = b''.join(chunks)
+    response._content_consumed = True
+
+
+def not_sent(error):
+    """Whether the request failed before anything was sent upstream."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class Endpoint:
+    """Health and latency statistics of one upstream endpoint."""
+
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.unhealthy_until = 0
+        self.last_error = None
+
+    @property
+    def healthy(self):
+        return self.unhealthy_until <= time.time()
+
+    def as_dict(self):
+        return dict(
+            url=self.url,
+            healthy=self.healthy,
+            in_flight=self.in_flight,
+            requests=self.requests,
+            failures=self.failures,
+            consecutive_failures=self.consecutive_failures,
+            latency=self.latency,
+            last_error=self.last_error,
+        )
+
+
+class UpstreamPool:
+    """Route upstream requests over a set of equivalent endpoints.
+
+    Each request goes to the best healthy endpoint according to `selection`:
+    'latency' picks the lowest average response time, endpoints within
+    `latency_tolerance` of it counting as equal and ordered by requests in
+    flight, 'least-loaded' the lowest number of requests in flight. An
+    endpoint failing `max_failures` times in a row is skipped for
+    `retry_after` seconds. Idempotent requests are retried on the next
+    endpoint when one fails, other requests only when the connection could
+    not be established.
+
+    With `start_probes()`, every endpoint is also checked in the background,
+    so that the latency of endpoints not chosen stays current and unhealthy
+    endpoints come back without failing user requests.
+    """
+
+    def __init__(self, urls, selection='latency', max_failures=3,
+                 retry_after=30, latency_weight=0.2, latency_tolerance=0.25):
+        self.endpoints = [Endpoint(url.strip().strip('/'))
+                          for url in urls if url.strip()]
+        if selection not in ['latency', 'least-loaded']:
+            raise ValueError(f'unknown upstream selection {selection}')
+        self.selection = selection
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self.latency_weight = latency_weight
+        self.latency_tolerance = latency_tolerance
+        self.probers = []
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        """Endpoints in the order they should be tried."""
+        with self._lock:
+            healthy = [e for e in self.endpoints if e.healthy]
+            unhealthy = sorted([e for e in self.endpoints if not e.healthy],
+                               key=lambda e: e.unhealthy_until)
+            best = min([e.latency or 0 for e in healthy], default=0)
+
+            def latency_key(e):
+                latency = e.latency or 0
+                # near ties go to the least loaded, so that load spreads
+                if latency <= best * (1 + self.latency_tolerance):
+                    return (0, e.in_flight, latency)
+                return (1, latency, e.in_flight)
+
+            def load_key(e):
+                return (e.in_flight, e.latency or 0)
+
+            return sorted(healthy, key=latency_key
+                          if self.selection == 'latency'
+                          else load_key) + unhealthy
+
+    def _acquire(self, endpoint):
+        with self._lock:
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.in_flight -= 1
+
+    def _success(self, endpoint, latency):
+        with self._lock:
+            endpoint.consecutive_failures = 0
+            endpoint.unhealthy_until = 0
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += \
+                    self.latency_weight * (latency - endpoint.latency)
+
+    def _failure(self, endpoint, error):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            endpoint.last_error = error
+            if endpoint.consecutive_failures >= self.max_failures:
+                endpoint.unhealthy_until = time.time() + self.retry_after
+        logger.warning('upstream %s failed: %s', endpoint.url, error)
+
+    def request(self, session, method, path, destination=None,
+                total_timeout=None, **kwargs):
+        """Send a request to `path` on the best endpoint.
+
+        `destination` is the path of the Destination header of COPY and
+        MOVE, sent as a URL of the same endpoint. `total_timeout` bounds the
+        time spent over all attempts and, without stream=True, reading the
+        response. With stream=True the endpoint counts as in flight until
+        the response is closed.
+        """
+        candidates = self.candidates()
+        retryable = method in idempotent_methods and \
+            isinstance(kwargs.get('data'), (bytes, type(None)))
+        deadline = time.monotonic() + total_timeout if total_timeout else None
+        read_body = deadline is not None and not kwargs.get('stream')
+
+        for n, endpoint in enumerate(candidates):
+            last = n == len(candidates) - 1
+            url = endpoint.url + '/' + path.lstrip('/')
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise requests.exceptions.Timeout(
+                        f'total timeout of {total_timeout}s exceeded')
+                kwargs['timeout'] = bounded_timeout(
+                    kwargs.get('timeout'), remaining)
+            if destination is not None:
+                kwargs['headers'] = dict(
+                    kwargs.get('headers') or {},
+                    Destination=endpoint.url + '/' +
+                    quote(destination.lstrip('/')))
+
+            self._acquire(endpoint)
+            try:
+                if read_body:
+                    response = session.request(
+                        method, url, **dict(kwargs, stream=True))
+                    read_within(response, deadline)
+                else:
+                    response = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                self._release(endpoint)
+                self._failure(endpoint, str(e))
+                if last or not (retryable or not_sent(e)):
+                    raise
+                continue
+            except Exception:
+                self._release(endpoint)
+                raise
+
+            if response.status_code in failover_statuses:
+                self._failure(endpoint, f'status {response.status_code}')
+                if retryable and not last:
+                    response.close()
+                    self._release(endpoint)
+                    continue
+            else:
+                self._success(endpoint, response.elapsed.total_seconds())
+
+            if kwargs.get('stream'):
+                self._release_on_close(response, endpoint)
+            else:
+                self._release(endpoint)
+            return response
+
+    def probe(self, session, endpoint, path, timeout=None):
+        """Check `endpoint` with a PROPFIND of `path`, as a StorageProber
+        probe: its health and latency are updated as by a request."""
+        url = endpoint.url + '/' + quote(path.lstrip('/'))
+        try:
+            r = session.request('PROPFIND', url, headers={'Depth': '0'},
+                                timeout=timeout)
+            r.close()
+        except requests.exceptions.RequestException as e:
+            self._failure(endpoint, str(e))
+            return False, f'Unhealthy! - {e}'
+
+        if r.status_code in failover_statuses:
+            self._failure(endpoint, f'status {r.status_code}')
+            return False, f'Unhealthy! - status {r.status_code}'
+        self._success(endpoint, r.elapsed.total_seconds())
+        return True, 'OK'
+
+    def start_probes(self, session_factory, path, interval, timeout=None,
+                     credential_max_age=3600):
+        """Probe each endpoint every `interval` seconds in the background,
+        with sessions from `session_factory`."""
+        for endpoint in self.endpoints:
+            prober = StorageProber(
+                session_factory,
+                lambda session, endpoint=endpoint: self.probe(
+                    session, endpoint, path, timeout),
+                interval=interval, credential_max_age=credential_max_age)
+            prober.start()
+            self.probers.append(prober)
+
+    def stop_probes(self):
+        for prober in self.probers:
+            prober.stop()
+        self.probers = []
+
+    def _release_on_close(self, response, endpoint):
+        close = response.close
+        released = []
+
+        def close_and_release():
+            if not released:
+                released.append(True)
+                self._release(endpoint)
+            close()
+
+        response.close = close_and_release
+
+    def stats(self):
+        with self._lock:
+            return dict(selection=self.selection,
+                        endpoints=[e.as_dict() for e in self.endpoints])
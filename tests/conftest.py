@@ -1,14 +1,19 @@
+import base64
 import copy
 import hashlib
+import json
 import os
 import psutil
 import pytest
 import re
+import secrets
 import signal
 import subprocess
 import tempfile
 import time
+import zlib
 from threading import Thread
+from urllib.parse import parse_qs
 
 from contextlib import contextmanager
 from wsgidav.wsgidav_app import WsgiDAVApp
@@ -49,11 +54,78 @@ def app():
             f'http://{webdav_server_host}:{str(webdav_server_port)}/',
         'CTADS_UPSTREAM_BASEPATH': '',
         "SERVER_NAME": 'app',
+        # test client responses which are not read would keep their slot
+        # in the scheduling lanes
+        "CTADS_LANES": False,
     })
 
     yield app
 
 
+class MacaroonIssuer:
+    """Local stand-in for the dCache macaroon issuer.
+
+    A POST with a macaroon request returns a token scoped to the requested
+    path; a request with `?authz=<token>` is only served for that path.
+    """
+
+    def __init__(self, app, base_url):
+        self.app = app
+        self.base_url = base_url
+        self.issued = {}
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+
+        if environ['REQUEST_METHOD'] == 'POST' and \
+                environ.get('CONTENT_TYPE') == 'application/macaroon-request':
+            macaroon = secrets.token_urlsafe(16)
+            self.issued[macaroon] = path
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps({
+                'macaroon': macaroon,
+                'uri': {
+                    'targetWithMacaroon':
+                        f'{self.base_url}{path}?authz={macaroon}',
+                },
+            }).encode()]
+
+        authz = parse_qs(environ.get('QUERY_STRING', '')).get('authz')
+        if authz is not None and self.issued.get(authz[0]) != path:
+            start_response('403 Forbidden', [])
+            return [b'invalid macaroon']
+
+        return self.app(environ, start_response)
+
+
+class DigestResponder:
+    """Answer Want-Digest on GET and HEAD with the adler32 and md5 of the
+    file, like dCache does."""
+
+    def __init__(self, app, root):
+        self.app = app
+        self.root = root
+
+    def __call__(self, environ, start_response):
+        path = os.path.join(self.root, environ['PATH_INFO'].lstrip('/'))
+        if 'HTTP_WANT_DIGEST' not in environ or \
+                environ['REQUEST_METHOD'] not in ['GET', 'HEAD'] or \
+                not os.path.isfile(path):
+            return self.app(environ, start_response)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = "adler32={:08x},md5={}".format(
+            zlib.adler32(data),
+            base64.b64encode(hashlib.md5(data).digest()).decode())
+
+        def digest_start_response(status, headers, *args):
+            return start_response(
+                status, headers + [('Digest', digest)], *args)
+
+        return self.app(environ, digest_start_response)
+
+
 @contextmanager
 def upstream_webdav_server():
     """Set up and tear down a Cheroot server instance."""
@@ -79,10 +151,13 @@ def upstream_webdav_server():
             "verbose": 5,
         }
         app = WsgiDAVApp(config)
+        issuer = MacaroonIssuer(
+            DigestResponder(app, tmpdir),
+            f'http://{webdav_server_host}:{webdav_server_port}')
 
         server_args = {
             "bind_addr": (config["host"], config["port"]),
-            "wsgi_app": app,
+            "wsgi_app": issuer,
             "timeout": 30,
         }
         httpserver = wsgi.Server(**server_args)
@@ -0,0 +1,78 @@
+"""Replay a traffic capture against a downloadservice backed by the local
+WebDAV stand-in, and print the latency and throughput report.
+
+    PYTHONPATH=. python tests/replay.py trace.jsonl.gz --speed 4
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+from conftest import upstream_webdav_server, webdav_server_host, \
+    webdav_server_port
+from downloadservice.replay import format_report, load_trace, replay, seed
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for(url, timeout=30):
+    started = time.time()
+    while True:
+        try:
+            requests.get(url + '/health', timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            if time.time() - started > timeout:
+                raise
+            time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed-up factor, 0 for as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--port', type=int, default=5003)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = root_dir + ':' + env.get('PYTHONPATH', '')
+    env['CTADS_DISABLE_ALL_AUTH'] = 'True'
+    env['CTADS_UPSTREAM_ENDPOINT'] = \
+        f'http://{webdav_server_host}:{webdav_server_port}/'
+    env['CTADS_UPSTREAM_BASEPATH'] = ''
+    env.pop('CTADS_TRAFFIC_CAPTURE_PATH', None)
+
+    with upstream_webdav_server() as (server_dir, _):
+        seed(records, server_dir)
+
+        p = subprocess.Popen(
+            [sys.executable, 'downloadservice/cli.py',
+             '--host', '127.0.0.1', '--port', str(args.port),
+             '--workers', str(args.workers), '--threads', str(args.threads)],
+            cwd=root_dir, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = f'http://127.0.0.1:{args.port}'
+            wait_for(url)
+            report = replay(records, url, args.speed, args.concurrency)
+        finally:
+            p.terminate()
+            p.wait()
+
+    print(json.dumps(report, indent=2) if args.json
+          else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from conftest import upstream_webdav_server, webdav_server_port
+
+
+@pytest.mark.timeout(60)
+@pytest.mark.parametrize('workers', [1, 2])
+def test_workers(pytestconfig, workers):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = str(pytestconfig.rootdir) + ':' + \
+        env.get('PYTHONPATH', '')
+    env['CTADS_DISABLE_ALL_AUTH'] = 'True'
+
+    p = subprocess.Popen(
+        [sys.executable, 'downloadservice/cli.py', '--host', '127.0.0.1',
+         '--port', '5001', '--workers', str(workers), '--threads', '4',
+         '--max-requests', '20'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        session = requests.Session()
+
+        started = time.time()
+        while True:
+            try:
+                session.get('http://127.0.0.1:5001/health', timeout=1)
+                break
+            except requests.exceptions.ConnectionError:
+                assert time.time() - started < 30
+                time.sleep(0.2)
+
+        # workers are recycled several times, no request is refused
+        def get(_):
+            return requests.get('http://127.0.0.1:5001/health',
+                                headers={'Connection': 'close'}).status_code
+
+        with ThreadPoolExecutor(4) as pool:
+            assert set(pool.map(get, range(200))) == {200}
+    finally:
+        p.send_signal(signal.SIGTERM)
+        assert p.wait(timeout=20) == 0
+
+
+@pytest.mark.timeout(60)
+def test_workers_share_storage_probe(pytestconfig, tmp_path):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = str(pytestconfig.rootdir) + ':' + \
+        env.get('PYTHONPATH', '')
+    env.update({
+        'CTADS_DISABLE_ALL_AUTH': 'True',
+        'CTADS_UPSTREAM_ENDPOINT': f'http://127.0.0.1:{webdav_server_port}',
+        'CTADS_UPSTREAM_BASEPATH': '',
+        'CTADS_UPSTREAM_HEALTH_BASEFOLDER': 'lst',
+        'CTADS_STORAGE_STATUS_INTERVAL': '3600',
+        'CTADS_SHARED_CACHE_PATH': str(tmp_path / 'shared.sqlite'),
+    })
+
+    with upstream_webdav_server():
+        p = subprocess.Popen(
+            [sys.executable, 'downloadservice/cli.py', '--host', '127.0.0.1',
+             '--port', '5002', '--workers', '2', '--threads', '4'],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        def status():
+            return requests.get('http://127.0.0.1:5002/storage-status',
+                                headers={'Connection': 'close'}, timeout=5)
+
+        try:
+            started = time.time()
+            while True:
+                try:
+                    if status().status_code == 200:
+                        break
+                except requests.exceptions.ConnectionError:
+                    pass
+                assert time.time() - started < 30
+                time.sleep(0.2)
+
+            # both workers answer the result of the single prober
+            results = [status() for _ in range(20)]
+            assert {r.status_code for r in results} == {200}
+            assert len({r.json()['checked_at'] for r in results}) == 1
+        finally:
+            p.send_signal(signal.SIGTERM)
+            assert p.wait(timeout=20) == 0
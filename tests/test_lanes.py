@@ -0,0 +1,124 @@
+from typing import Any
+import threading
+import time
+import pytest
+from flask import url_for
+from conftest import upstream_webdav_server, generate_random_file
+from downloadservice.app import get_lane_scheduler
+
+
+@pytest.fixture
+def small_lanes(app: Any):
+    config = {
+        'CTADS_LANES': True,
+        'CTADS_INTERACTIVE_CAPACITY': 1,
+        'CTADS_INTERACTIVE_QUEUE': 1,
+        'CTADS_BULK_CAPACITY': 1,
+        'CTADS_BULK_QUEUE': 1,
+    }
+    saved = {k: app.config[k] for k in config}
+    app.config.update(config)
+    app.extensions.pop('lane_scheduler', None)
+
+    yield get_lane_scheduler()
+
+    app.config.update(saved)
+    app.extensions.pop('lane_scheduler', None)
+
+
+def wait_until(condition, timeout=10):
+    started = time.time()
+    while not condition():
+        assert time.time() - started < timeout
+        time.sleep(0.01)
+
+
+@pytest.mark.timeout(30)
+def test_lanes(app: Any, client: Any, small_lanes):
+    scheduler = small_lanes
+    fetch_url = url_for('fetch', path='lst/users/anonymous/example-files/f')
+    list_url = url_for('list_dir', path='lst')
+    done = []
+
+    def get(url):
+        # test clients are not shared between threads
+        r = app.test_client().get(url)
+        # reading the body releases the slot
+        r.data
+        done.append((url, r.status_code))
+
+    with upstream_webdav_server() as (server_dir, _):
+        generate_random_file(
+            f"{server_dir}/lst/users/anonymous/example-files/f", 1024)
+
+        bulk = scheduler.acquire('bulk')
+        transfer = threading.Thread(target=get, args=(fetch_url,))
+        transfer.start()
+        wait_until(lambda: scheduler.stats()['bulk']['waiting'] == 1)
+
+        # the bulk queue is full
+        r = client.get(fetch_url)
+        assert r.status_code == 503
+        assert r.headers['Retry-After'] == '5'
+
+        # listings do not wait behind transfers
+        r = client.get(list_url)
+        assert r.status_code == 200
+        assert r.json
+
+        interactive = scheduler.acquire('interactive')
+        check = threading.Thread(target=get, args=(list_url,))
+        check.start()
+        wait_until(
+            lambda: scheduler.stats()['interactive']['waiting'] == 1)
+
+        # the freed bulk slot goes to the waiting interactive request first
+        scheduler.release('bulk', bulk)
+        check.join()
+        transfer.join()
+        scheduler.release('interactive', interactive)
+
+    assert done == [(list_url, 200), (fetch_url, 200)]
+
+    r = client.get(url_for('lane_status'))
+    assert r.status_code == 200
+    bulk, interactive = r.json['bulk'], r.json['interactive']
+    assert bulk['rejected'] == 1
+    assert bulk['used'] == 0
+    # the status request itself
+    assert interactive['used'] == 1
+    assert bulk['wait']['max'] > 0
+    assert interactive['wait']['max'] > 0
+
+
+@pytest.mark.timeout(30)
+def test_probes_not_scheduled(app: Any, client: Any, small_lanes):
+    scheduler = small_lanes
+    scheduler.queue_timeout = 0.1
+    # no prober thread outliving the test
+    interval = app.config['CTADS_STORAGE_STATUS_INTERVAL']
+    app.config['CTADS_STORAGE_STATUS_INTERVAL'] = 0
+    app.extensions.pop('storage_prober', None)
+
+    try:
+        with upstream_webdav_server():
+            taken = [(name, scheduler.acquire(name))
+                     for name in ['interactive', 'bulk']]
+
+            # other requests time out waiting for a slot
+            r = client.get(url_for('list_dir', path='lst'))
+            assert r.status_code == 503
+
+            r = client.get(url_for('health'))
+            assert r.status_code == 200
+            # answered by the disabled prober, not refused by the lane
+            r = client.get(url_for('storage_status'))
+            assert r.json['healthy'] is None
+
+            for name, pool in taken:
+                scheduler.release(name, pool)
+    finally:
+        app.config['CTADS_STORAGE_STATUS_INTERVAL'] = interval
+        app.extensions.pop('storage_prober', None)
+
+    assert scheduler.stats()['interactive']['timed_out'] == 1
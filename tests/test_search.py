@@ -0,0 +1,87 @@
+from typing import Any
+import os
+import tempfile
+import time
+import pytest
+from flask import url_for
+from conftest import upstream_webdav_server, generate_random_file
+
+
+@pytest.fixture
+def metadata_index(app: Any):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app.config.update({
+            'CTADS_INDEX_PATH': os.path.join(tmpdir, 'index.sqlite'),
+            'CTADS_INDEX_INTERVAL': 0,
+        })
+
+        from downloadservice.app import get_metadata_index
+        get_metadata_index()
+
+        yield app.extensions['metadata_indexer']
+
+        app.extensions.pop('metadata_index')
+        app.extensions.pop('metadata_indexer')
+        app.config['CTADS_INDEX_PATH'] = ''
+
+
+@pytest.mark.timeout(30)
+def test_search(app: Any, client: Any, metadata_index):
+    with upstream_webdav_server() as (server_dir, _):
+        data_dir = f"{server_dir}/lst/DL2/source-x"
+        os.makedirs(data_dir)
+        for i in range(5):
+            generate_random_file(f"{data_dir}/run-{i}.h5", 1000 * (i + 1))
+        generate_random_file(f"{data_dir}/run.log", 10)
+
+        metadata_index.crawl_once()
+
+        r = client.get(url_for('search', glob='lst/DL2/*.h5'))
+        assert r.status_code == 200
+        assert [e['href'] for e in r.json] == \
+            [f'lst/DL2/source-x/run-{i}.h5' for i in range(5)]
+        assert r.json[0]['size'] == 1000
+        assert r.json[0]['type'] == 'file'
+
+        r = client.get(url_for('search', glob='*.h5', size_min=2500))
+        assert len(r.json) == 3
+
+        r = client.get(url_for('search', glob='*.h5',
+                               mtime_min=time.time() + 3600))
+        assert r.json == []
+
+        r = client.get(url_for('search', size_min='large'))
+        assert r.status_code == 400
+
+
+@pytest.mark.timeout(30)
+def test_search_incremental(app: Any, client: Any, metadata_index):
+    with upstream_webdav_server() as (server_dir, _):
+        metadata_index.crawl_once()
+        listings = metadata_index.stats['listings']
+
+        metadata_index.crawl_once()
+        assert metadata_index.stats['listings'] == listings
+
+        time.sleep(1)
+        generate_random_file(
+            f"{server_dir}/lst/users/anonymous/new-file", 10)
+        metadata_index.crawl_once()
+        assert metadata_index.stats['listings'] == listings + 1
+
+        r = client.get(url_for('search', glob='*/new-file'))
+        assert [e['href'] for e in r.json] == \
+            ['lst/users/anonymous/new-file']
+
+        # removed entries also leave the path index
+        time.sleep(1)
+        os.remove(f"{server_dir}/lst/users/anonymous/new-file")
+        metadata_index.crawl_once()
+        r = client.get(url_for('search', glob='*/new-file'))
+        assert r.json == []
+
+
+@pytest.mark.timeout(30)
+def test_search_disabled(app: Any, client: Any):
+    r = client.get(url_for('search', glob='*'))
+    assert r.status_code == 404
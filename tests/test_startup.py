@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+import pytest
+
+# seconds allowed to import the app module
+import_time_budget = float(os.getenv('CTADS_TEST_IMPORT_TIME_BUDGET', '1.5'))
+
+
+@pytest.mark.timeout(60)
+def test_import_time():
+    code = '\n'.join([
+        'import sys, time',
+        't = time.perf_counter()',
+        'import downloadservice.app',
+        'print(time.perf_counter() - t)',
+        'print(sorted({"sentry_sdk", "jupyterhub"} & set(sys.modules)))',
+    ])
+
+    timings = []
+    for _ in range(3):
+        r = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                           text=True, check=True)
+        elapsed, loaded = r.stdout.splitlines()
+        timings.append(float(elapsed))
+
+        # initialized on first use
+        assert loaded == '[]'
+
+    assert min(timings) < import_time_budget
@@ -0,0 +1,83 @@
+from typing import Any
+import os
+import pytest
+from flask import url_for
+from conftest import upstream_webdav_server, generate_random_file
+from downloadservice.replay import load_trace, replay, seed
+
+
+@pytest.fixture
+def traffic_capture(app: Any, tmp_path):
+    path = str(tmp_path / 'trace.jsonl.gz')
+    saved = app.config['CTADS_TRAFFIC_CAPTURE_PATH']
+    app.config['CTADS_TRAFFIC_CAPTURE_PATH'] = path
+    app.extensions.pop('traffic_recorder', None)
+
+    yield path
+
+    app.config['CTADS_TRAFFIC_CAPTURE_PATH'] = saved
+    app.extensions.pop('traffic_recorder', None)
+
+
+@pytest.mark.timeout(60)
+def test_capture_replay(app: Any, client: Any, traffic_capture,
+                        testing_download_service):
+    with upstream_webdav_server() as (server_dir, _):
+        user_dir = f"{server_dir}/lst/users/anonymous/example-files"
+        generate_random_file(f"{user_dir}/run-1234.fits.fz", 10000)
+
+        # records are written once the responses are closed
+        for _ in range(3):
+            with client.get(
+                    url_for('list_dir',
+                            path='lst/users/anonymous/example-files'),
+                    query_string={'format': 'ndjson', 'sort': '-size',
+                                  'fields': 'href,size',
+                                  'glob': 'run-*'}) as r:
+                assert r.status_code == 200
+        with client.get(url_for(
+                'fetch',
+                path='lst/users/anonymous/example-files/run-1234.fits.fz'),
+                query_string={'chunk_size': 4096}) as r:
+            assert len(r.data) == 10000
+        with client.post(url_for('upload', path='example-files/new.fits'),
+                         data=b'x' * 5000) as r:
+            assert r.status_code == 200
+        with client.get(url_for('health')) as r:
+            assert r.status_code == 200
+
+    app.extensions['traffic_recorder'].flush()
+    records = load_trace(traffic_capture)
+    assert [r['r'] for r in records] == \
+        ['list_dir'] * 3 + ['fetch', 'upload', 'health']
+
+    # names are hashed consistently, keeping their extension
+    listing, fetch, upload = records[0], records[3], records[4]
+    assert listing['p'] == records[1]['p']
+    assert listing['p'].startswith('lst/users/{user}/')
+    assert listing['q'] == {'format': 'ndjson', 'sort': '-size',
+                            'fields': 'href,size'}
+    assert fetch['p'].startswith(listing['p'] + '/')
+    assert fetch['p'].endswith('.fits.fz')
+    assert fetch['q'] == {'chunk_size': '4096'}
+    assert fetch['o'] == 10000
+    assert upload['i'] == 5000
+    assert upload['p'].endswith('.fits')
+    assert all(r['s'] == 200 and r['d'] > 0 for r in records)
+    with open(traffic_capture, 'rb') as f:
+        raw = f.read()
+    for name in [b'example-files', b'run-1234', b'anonymous']:
+        assert name not in raw
+
+    with upstream_webdav_server() as (server_dir, _):
+        seed(records, server_dir)
+        assert os.path.getsize(os.path.join(server_dir, fetch['p'].replace(
+            '{user}', 'anonymous'))) == 10000
+
+        report = replay(records, 'http://127.0.0.1:5000', speed=0)
+
+    assert report['requests'] == 6
+    assert report['errors'] == 0
+    assert report['routes']['fetch']['requests'] == 1
+    assert report['bytes_per_second'] > 0
+    assert set(report['latency']) == {'p50', 'p90', 'p99', 'max'}
@@ -1,9 +1,25 @@
 from typing import Any
+from contextlib import contextmanager
+import gzip
+import io
+import json
+import os
 import pytest
+import requests
+import socket
+import zlib
+import time
 from flask import url_for
 import xmltodict
+import tarfile
 import tempfile
 from conftest import upstream_webdav_server, generate_random_file, hash_file
+import downloadservice.app
+from downloadservice.app import (
+    CertificateError, get_limiters, get_read_ahead_pool
+)
+from downloadservice.limits import LimitExceeded, SharedUsageLimiter, Slot
+from downloadservice.streaming import ResumeError
 
 
 @pytest.mark.timeout(30)
@@ -66,3 +82,540 @@ def test_webdav_list(app: Any, client: Any):
 
         assert set([e['ns0:href'] for e in xml_res['ns0:multistatus']
                    ['ns0:response']]) == set(expected)
+
+
+@pytest.mark.timeout(30)
+def test_upload(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            local_file = f"{tmpdir}/local-file"
+            generate_random_file(local_file, 5 * (1024**2))
+
+            with open(local_file, 'rb') as f:
+                r = client.post(
+                    url_for('upload', path='example-files/uploaded',
+                            chunk_size=1024**2),
+                    data=f.read())
+            assert r.status_code == 200
+            assert r.json['total_written'] == 5 * (1024**2)
+
+            remote_file = \
+                f"{server_dir}/lst/users/anonymous/example-files/uploaded"
+            assert hash_file(local_file) == hash_file(remote_file)
+
+
+def adler32_digest(filename):
+    with open(filename, 'rb') as f:
+        return 'adler32={:08x}'.format(zlib.adler32(f.read()))
+
+
+@pytest.mark.timeout(30)
+def test_upload_already_present(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            local_file = f"{tmpdir}/local-file"
+            generate_random_file(local_file, 1024**2)
+            url = url_for('upload', path='example-files/uploaded')
+
+            with open(local_file, 'rb') as f:
+                data = f.read()
+
+            r = client.post(url, data=data,
+                            headers={'Digest': adler32_digest(local_file)})
+            assert r.json['status'] == 'uploaded'
+
+            r = client.post(url, data=data,
+                            headers={'Digest': adler32_digest(local_file)})
+            assert r.status_code == 200
+            assert r.json['status'] == 'already present'
+            assert r.json['total_written'] == 0
+
+            # changed locally
+            generate_random_file(local_file, 1024**2)
+            with open(local_file, 'rb') as f:
+                data = f.read()
+            r = client.post(url, data=data,
+                            headers={'Digest': adler32_digest(local_file)})
+            assert r.json['status'] == 'uploaded'
+
+            remote_file = \
+                f"{server_dir}/lst/users/anonymous/example-files/uploaded"
+            assert hash_file(local_file) == hash_file(remote_file)
+
+
+@pytest.mark.timeout(30)
+def test_upload_expect_continue(testing_download_service):
+    with upstream_webdav_server() as (server_dir, _):
+        remote_file = f"{server_dir}/lst/users/anonymous/example-files/file"
+        generate_random_file(remote_file, 1024)
+
+        def send_headers(digest):
+            s = socket.create_connection(('127.0.0.1', 5000))
+            s.sendall((
+                'POST /upload/example-files/file HTTP/1.1\r\n'
+                'Host: 127.0.0.1\r\n'
+                'Content-Length: 1024\r\n'
+                f'Digest: {digest}\r\n'
+                'Expect: 100-continue\r\n\r\n').encode())
+            return s
+
+        def read_all(s):
+            response = b''
+            while buf := s.recv(65536):
+                response += buf
+            return response
+
+        # answered without the body being sent
+        s = send_headers(adler32_digest(remote_file))
+        response = read_all(s).decode()
+        assert response.startswith('HTTP/1.1 200')
+        assert '100 Continue' not in response
+        assert 'already present' in response
+
+        s = send_headers('adler32=00000000')
+        assert s.recv(65536).startswith(b'HTTP/1.1 100 Continue')
+        s.sendall(os.urandom(1024))
+        s.shutdown(socket.SHUT_WR)
+        assert '"uploaded"' in read_all(s).decode()
+
+
+@pytest.mark.timeout(30)
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_list_compressed(app: Any, client: Any, encoding):
+    if encoding == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+
+    with upstream_webdav_server() as (server_dir, _):
+        for i in range(50):
+            generate_random_file(f"{server_dir}/lst/file-{i}", 10)
+
+        r = client.get(url_for('list_dir', path="lst"),
+                       headers={'Accept-Encoding': encoding})
+        assert r.status_code == 200
+        assert r.headers['Content-Encoding'] == encoding
+        assert 'Content-Length' not in r.headers
+
+        if encoding == 'gzip':
+            data = gzip.decompress(r.get_data())
+        else:
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(
+                r.get_data())
+        assert len(json.loads(data)) == 52
+
+        r = client.get(url_for('list_dir', path="lst"))
+        assert 'Content-Encoding' not in r.headers
+        assert len(r.json) == 52
+
+
+@pytest.mark.timeout(30)
+def test_fetch_not_compressed(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        generate_random_file(f"{server_dir}/lst/file", 1024**2)
+
+        r = client.get(url_for('fetch', path="lst/file"),
+                       headers={'Accept-Encoding': 'gzip'})
+        assert r.status_code == 200
+        assert 'Content-Encoding' not in r.headers
+        assert len(r.get_data()) == 1024**2
+
+
+@pytest.mark.timeout(30)
+def test_webdav_json_not_compressed(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        data = json.dumps([{'run': i} for i in range(1000)]).encode()
+        with open(f"{server_dir}/lst/runs.json", 'wb') as f:
+            f.write(data)
+
+        r = client.get(url_for('webdav', path="lst/runs.json"),
+                       headers={'Accept-Encoding': 'gzip'})
+        assert r.status_code == 200
+        assert 'Content-Encoding' not in r.headers
+        assert r.get_data() == data
+
+        r = client.get(url_for('webdav', path="lst/runs.json"),
+                       headers={'Accept-Encoding': 'gzip',
+                                'Range': 'bytes=0-4095'})
+        assert r.status_code == 206
+        assert 'Content-Encoding' not in r.headers
+        assert r.headers['Content-Range'] == f'bytes 0-4095/{len(data)}'
+        assert r.get_data() == data[:4096]
+
+
+@pytest.mark.timeout(30)
+def test_list_filtered(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        for i in range(5):
+            generate_random_file(f"{server_dir}/lst/run-{i}.h5", 100 * i)
+        generate_random_file(f"{server_dir}/lst/run.log", 10)
+
+        r = client.get(url_for('list_dir', path="lst", glob='*.h5',
+                               size_min=150, sort='-size',
+                               fields='href,size'))
+        assert r.status_code == 200
+        assert r.json == [{'href': f'lst/run-{i}.h5', 'size': 100 * i}
+                          for i in [4, 3, 2]]
+
+        r = client.get(url_for('list_dir', path="lst", type='directory'))
+        assert set(e['href'] for e in r.json) == {'lst/', 'lst/users/'}
+
+        r = client.get(url_for('list_dir', path="lst", regex=r'^run\.'))
+        assert [e['href'] for e in r.json] == ['lst/run.log']
+        assert isinstance(r.json[0]['mtime'], float)
+
+        r = client.get(url_for('list_dir', path="lst", sort='name'))
+        assert r.status_code == 400
+
+
+@pytest.mark.timeout(30)
+def test_list_formats(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        for i in range(3):
+            generate_random_file(f"{server_dir}/lst/run-{i}.h5", 10 * i)
+
+        r = client.get(url_for('list_dir', path="lst", sort='href'))
+        expected = r.json
+
+        r = client.get(url_for('list_dir', path="lst", sort='href',
+                               format='ndjson'))
+        assert r.mimetype == 'application/x-ndjson'
+        assert [json.loads(line) for line in r.get_data().splitlines()] == \
+            expected
+
+        r = client.get(url_for('list_dir', path="lst", sort='href',
+                               format='columnar'))
+        listing = r.json
+        assert listing['count'] == len(expected) == 5
+        assert listing['columns']['href'] == [e['href'] for e in expected]
+        assert listing['columns']['size'] == [e.get('size') for e in expected]
+        assert [listing['url_prefix'] + href
+                for href in listing['columns']['href']] == \
+            [e['url'] for e in expected]
+
+        r = client.get(url_for('list_dir', path="lst", sort='href',
+                               format='columnar', fields='size'))
+        assert list(r.json['columns']) == ['size']
+
+        r = client.get(url_for('list_dir', path="lst", format='xml'))
+        assert r.status_code == 400
+
+        msgpack = pytest.importorskip('msgpack')
+        r = client.get(url_for('list_dir', path="lst", sort='href',
+                               format='msgpack'))
+        assert r.mimetype == 'application/msgpack'
+        assert msgpack.unpackb(r.get_data()) == listing
+
+
+def break_upstream_once(monkeypatch, after_chunks, on_break=None):
+    """Make the first upstream response fail after `after_chunks` chunks."""
+    iter_content = requests.models.Response.iter_content
+    broken = []
+
+    def flaky_iter_content(self, *args, **kwargs):
+        for n, chunk in enumerate(iter_content(self, *args, **kwargs)):
+            if n == after_chunks and not broken:
+                broken.append(True)
+                if on_break is not None:
+                    on_break()
+                raise requests.exceptions.ChunkedEncodingError(
+                    'connection reset')
+            yield chunk
+
+    monkeypatch.setattr(requests.models.Response, 'iter_content',
+                        flaky_iter_content)
+    monkeypatch.setattr(time, 'sleep', lambda _: None)
+
+
+@pytest.mark.timeout(30)
+def test_download_resumed(app: Any, client: Any, monkeypatch):
+    with upstream_webdav_server() as (server_dir, _):
+        remote_file = f"{server_dir}/lst/remote-file"
+        generate_random_file(remote_file, 5 * (1024**2))
+
+        break_upstream_once(monkeypatch, 2)
+
+        r = client.get(url_for('fetch', path="lst/remote-file",
+                               chunk_size=1024**2))
+        assert r.status_code == 200
+        assert r.headers['Content-Length'] == str(5 * (1024**2))
+
+        with open(remote_file, 'rb') as f:
+            assert r.get_data() == f.read()
+
+
+@pytest.fixture
+def read_ahead(app):
+    config = {k: app.config[k] for k in [
+        'CTADS_FETCH_READ_AHEAD', 'CTADS_FETCH_READ_AHEAD_TOTAL',
+        'CTADS_FETCH_SPILL_DIR', 'CTADS_FETCH_SPILL_SIZE']}
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        app.config.update({
+            'CTADS_FETCH_READ_AHEAD': 1024**2,
+            'CTADS_FETCH_READ_AHEAD_TOTAL': 1024**2,
+            'CTADS_FETCH_SPILL_DIR': spill_dir,
+            'CTADS_FETCH_SPILL_SIZE': 2 * 1024**2,
+        })
+        app.extensions.pop('read_ahead_pool', None)
+        yield
+        app.config.update(config)
+        app.extensions.pop('read_ahead_pool', None)
+
+
+@pytest.mark.timeout(30)
+def test_download_read_ahead(app: Any, client: Any, read_ahead):
+    with upstream_webdav_server() as (server_dir, _):
+        remote_file = f"{server_dir}/lst/remote-file"
+        generate_random_file(remote_file, 8 * (1024**2))
+
+        r = client.get(url_for('fetch', path="lst/remote-file",
+                               chunk_size=256 * 1024), buffered=False)
+        assert r.status_code == 200
+        chunks = r.response
+        data = next(chunks)
+
+        # the upstream is read ahead while the client is stalled, until the
+        # memory and disk buffers are full
+        started = time.time()
+        while get_read_ahead_pool().stats()['spilled'] < 2 * 1024**2:
+            assert time.time() - started < 10
+            time.sleep(0.05)
+        stats = get_read_ahead_pool().stats()
+        assert stats['buffers'] == 1
+        assert stats['used'] <= 1024**2
+
+        data += b''.join(chunks)
+        r.close()
+        with open(remote_file, 'rb') as f:
+            assert data == f.read()
+
+        stats = get_read_ahead_pool().stats()
+        assert stats['buffers'] == stats['used'] == stats['spilled'] == 0
+        assert stats['peak'] >= 256 * 1024
+
+
+@pytest.mark.timeout(30)
+def test_download_not_resumed_when_changed(app: Any, client: Any,
+                                           monkeypatch):
+    with upstream_webdav_server() as (server_dir, _):
+        remote_file = f"{server_dir}/lst/remote-file"
+        generate_random_file(remote_file, 5 * (1024**2))
+
+        def change_file():
+            generate_random_file(remote_file, 5 * (1024**2))
+            os.utime(remote_file, (time.time() + 10, time.time() + 10))
+
+        break_upstream_once(monkeypatch, 2, change_file)
+
+        r = client.get(url_for('fetch', path="lst/remote-file",
+                               chunk_size=1024**2))
+        with pytest.raises(ResumeError):
+            r.get_data()
+
+
+@pytest.mark.timeout(30)
+def test_download_redirect(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, server):
+        remote_file = f"{server_dir}/lst/remote-file"
+        generate_random_file(remote_file, 1024**2)
+
+        r = client.get(url_for('fetch', path="lst/remote-file",
+                               mode='redirect'))
+        assert r.status_code == 400
+
+        redirect = app.config['CTADS_FETCH_REDIRECT']
+        app.config['CTADS_FETCH_REDIRECT'] = True
+        try:
+            r = client.get(url_for('fetch', path="lst/remote-file",
+                                   mode='redirect'))
+            assert r.status_code == 307
+            location = r.headers['Location']
+            assert 'authz=' in location
+
+            r = client.get(url_for('fetch', path="lst/remote-file",
+                                   mode='redirect'))
+            assert r.headers['Location'] == location
+            assert len(server['issuer'].issued) == 1
+
+            with open(remote_file, 'rb') as f:
+                assert requests.get(location).content == f.read()
+            assert requests.get(
+                location.replace('remote-file', 'users')).status_code == 403
+        finally:
+            app.config['CTADS_FETCH_REDIRECT'] = redirect
+
+
+@pytest.mark.timeout(30)
+def test_bulk_stat(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        for i in range(20):
+            generate_random_file(f"{server_dir}/lst/file-{i}", i)
+
+        paths = [f"lst/file-{i}" for i in range(20)] + \
+            ["lst/users/", "lst/missing", "lst/../etc"]
+        r = client.post(url_for('bulk_stat'),
+                        json={'paths': paths, 'checksums': True})
+        assert r.status_code == 200
+        assert [e['path'] for e in r.json] == paths
+
+        for i, entry in enumerate(r.json[:20]):
+            assert entry['size'] == i
+            assert entry['type'] == 'file'
+            assert isinstance(entry['mtime'], float)
+            assert 'checksums' in entry
+
+        assert r.json[20]['type'] == 'directory'
+        assert r.json[21]['error'].startswith('404')
+        assert 'error' in r.json[22]
+
+        r = client.post(url_for('bulk_stat'), json={'paths': 'lst'})
+        assert r.status_code == 400
+
+
+@pytest.mark.timeout(30)
+def test_upload_tar(app: Any, client: Any):
+    with upstream_webdav_server() as (server_dir, _):
+        contents = {f'outputs/run-{i}/result.txt': os.urandom(100 * i)
+                    for i in range(10)}
+        contents['large.bin'] = os.urandom(2 * 1024**2)
+
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for name, content in contents.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            info = tarfile.TarInfo('../escape.txt')
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'x'))
+
+        buffer_size = app.config['CTADS_TAR_MEMBER_BUFFER_SIZE']
+        app.config['CTADS_TAR_MEMBER_BUFFER_SIZE'] = 1024**2
+        try:
+            r = client.post(url_for('upload_tar', path='example-files/tar'),
+                            data=archive.getvalue())
+        finally:
+            app.config['CTADS_TAR_MEMBER_BUFFER_SIZE'] = buffer_size
+
+        assert r.status_code == 200
+        assert r.json['status'] == 'partial'
+        results = {f['name']: f for f in r.json['files']}
+        assert results['../escape.txt']['status'] == 'error'
+        assert r.json['total_written'] == \
+            sum(len(content) for content in contents.values())
+
+        target = f"{server_dir}/lst/users/anonymous/example-files/tar"
+        for name, content in contents.items():
+            assert results[name]['status'] == 'uploaded'
+            with open(f"{target}/{name}", 'rb') as f:
+                assert f.read() == content
+
+
+@pytest.fixture(params=['process', 'shared'])
+def transfer_limits(app: Any, request, tmp_path):
+    config = {k: app.config[k] for k in [
+        'CTADS_USER_MAX_STREAMS', 'CTADS_USER_BANDWIDTH',
+        'CTADS_SHARED_CACHE_PATH']}
+    app.extensions.pop('limiters', None)
+    app.extensions.pop('caches', None)
+    app.config.update({
+        'CTADS_USER_MAX_STREAMS': 1,
+        'CTADS_USER_BANDWIDTH': 1024**2,
+        'CTADS_SHARED_CACHE_PATH': str(tmp_path / 'shared.sqlite')
+        if request.param == 'shared' else '',
+    })
+
+    yield
+
+    app.config.update(config)
+    app.extensions.pop('limiters', None)
+    app.extensions.pop('caches', None)
+
+
+@pytest.mark.timeout(30)
+def test_transfer_limits(app: Any, client: Any, transfer_limits):
+    with upstream_webdav_server() as (server_dir, _):
+        remote_file = f"{server_dir}/lst/remote-file"
+        generate_random_file(remote_file, 2 * 1024**2)
+
+        # a transfer in progress
+        slot = Slot(get_limiters(), ['anonymous', 'lst'])
+
+        r = client.get(url_for('usage'))
+        assert r.json['users']['anonymous']['active'] == 1
+
+        r = client.get(url_for('fetch', path="lst/remote-file"))
+        assert r.status_code == 429
+        assert r.headers['Retry-After'] == '5'
+
+        slot.release()
+
+        started = time.time()
+        r = client.get(url_for('fetch', path="lst/remote-file",
+                               chunk_size=256 * 1024))
+        assert r.status_code == 200
+        assert len(r.get_data()) == 2 * 1024**2
+        r.close()
+        assert time.time() - started > 0.8
+
+        r = client.get(url_for('usage'))
+        assert r.json['users']['anonymous'] == \
+            {'active': 0, 'transferred': 2 * 1024**2}
+
+
+@pytest.mark.timeout(30)
+def test_transfer_limits_certificate_error(app: Any, client: Any,
+                                           transfer_limits, monkeypatch):
+    @contextmanager
+    def failing_session(user, certificate_key):
+        raise CertificateError('Error while retrieving certificate: 403')
+        yield
+
+    monkeypatch.setattr(downloadservice.app, 'get_upstream_session',
+                        failing_session)
+    monkeypatch.setattr(downloadservice.app, 'select_upload_base_folder',
+                        lambda: ('lst', 'lst/users'))
+
+    # each transfer releases its slot, the next one is not refused
+    for _ in range(2):
+        for r in [
+            client.get(url_for('webdav', path='lst/remote-file')),
+            client.get(url_for('fetch', path='lst/remote-file')),
+            client.post(url_for('upload', path='example-files/file'),
+                        data=b'content'),
+            client.post(url_for('upload_tar', path='example-files'),
+                        data=b''),
+        ]:
+            assert r.status_code == 400
+
+    r = client.get(url_for('usage'))
+    assert r.json['users']['anonymous']['active'] == 0
+
+
+def test_shared_transfer_limits(tmp_path):
+    path = str(tmp_path / 'shared.sqlite')
+    # two worker processes
+    first, second = [SharedUsageLimiter(path, 'user', 3, 1024**2)
+                     for _ in range(2)]
+    second.pid += 1
+
+    first.acquire('alice')
+    usage = second.acquire('alice')
+    usage.record(1000)
+    second.acquire('alice')
+    with pytest.raises(LimitExceeded):
+        first.acquire('alice')
+    assert first.stats() == \
+        {'alice': {'active': 3, 'transferred': 1000}}
+
+    # the bandwidth is split by streams
+    first.sync('alice')
+    assert first.usages['alice'].bucket.rate == 1024**2 / 3
+    assert usage.bucket.rate == 2 * 1024**2 / 3
+
+    # the second process exited
+    SharedUsageLimiter.forget_process(path, second.pid)
+    first.sync('alice')
+    assert first.usages['alice'].bucket.rate == 1024**2
+    first.acquire('alice')
+    assert first.stats() == \
+        {'alice': {'active': 2, 'transferred': 1000}}
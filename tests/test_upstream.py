@@ -0,0 +1,196 @@
+from typing import Any
+import socket
+import time
+import pytest
+from flask import url_for
+import requests
+from conftest import upstream_webdav_server
+from downloadservice.upstream import UpstreamPool
+from downloadservice.app import get_storage_prober
+
+
+@pytest.fixture
+def multiple_endpoints(app: Any):
+    config = {k: app.config[k] for k in [
+        'CTADS_UPSTREAM_ENDPOINT', 'CTADS_UPSTREAM_SELECTION',
+        'CTADS_UPSTREAM_PROBE_INTERVAL']}
+    endpoint = app.config['CTADS_UPSTREAM_ENDPOINT']
+    # nothing listens on port 1
+    app.config['CTADS_UPSTREAM_ENDPOINT'] = \
+        'http://127.0.0.1:1,' + endpoint
+    app.config['CTADS_UPSTREAM_SELECTION'] = 'least-loaded'
+    # only user requests count
+    app.config['CTADS_UPSTREAM_PROBE_INTERVAL'] = 0
+    app.extensions.pop('upstream_pool', None)
+
+    yield
+
+    app.config.update(config)
+    app.extensions.pop('upstream_pool', None)
+
+
+def test_endpoint_near_ties():
+    pool = UpstreamPool(['http://a', 'http://b', 'http://c'])
+    a, b, c = pool.endpoints
+    a.latency, b.latency, c.latency = 0.010, 0.012, 0.050
+    a.in_flight, c.in_flight = 2, 0
+    # b is as fast as a and less loaded, c is much slower
+    assert pool.candidates() == [b, a, c]
+
+    b.latency = 0.020
+    assert pool.candidates() == [a, b, c]
+
+
+@pytest.mark.timeout(30)
+def test_endpoint_probes():
+    with upstream_webdav_server():
+        pool = UpstreamPool(['http://127.0.0.1:31102',
+                             'http://localhost:31102'])
+        fast, stale = pool.endpoints
+        # measured once when slow, then never chosen again
+        stale.latency = 5.0
+        fast.unhealthy_until = time.time() + 3600
+
+        pool.start_probes(requests.Session, 'lst', 0.1)
+        try:
+            started = time.time()
+            while stale.latency > 1 or not fast.healthy:
+                assert time.time() - started < 10
+                time.sleep(0.05)
+        finally:
+            pool.stop_probes()
+        assert stale.failures == fast.failures == 0
+
+
+@pytest.mark.timeout(30)
+def test_failover(app: Any, client: Any, multiple_endpoints):
+    with upstream_webdav_server():
+        for _ in range(4):
+            r = client.get(url_for('list_dir', path="lst"))
+            assert r.status_code == 200
+
+        r = client.get(url_for('upstream_status'))
+        dead, alive = r.json['endpoints']
+        assert dead['url'] == 'http://127.0.0.1:1'
+        assert dead['failures'] == 3
+        assert not dead['healthy']
+        assert alive['requests'] == 4
+        assert alive['failures'] == 0
+        assert alive['in_flight'] == 0
+
+
+@pytest.mark.timeout(30)
+def test_failover_writes_not_sent(app: Any, client: Any,
+                                  multiple_endpoints):
+    with upstream_webdav_server() as (server_dir, _):
+        r = client.post(url_for('upload', path='example-files/uploaded'),
+                        data=b'content')
+        assert r.status_code == 200
+
+        remote_file = \
+            f"{server_dir}/lst/users/anonymous/example-files/uploaded"
+        with open(remote_file, 'rb') as f:
+            assert f.read() == b'content'
+
+
+@pytest.mark.timeout(30)
+def test_storage_status(app: Any, client: Any):
+    saved = {k: app.config[k] for k in [
+        'CTADS_STORAGE_STATUS_INTERVAL', 'CTADS_UPSTREAM_HEALTH_BASEFOLDER']}
+    # one probe from the thread, the next ones by hand
+    app.config['CTADS_STORAGE_STATUS_INTERVAL'] = 3600
+    app.config['CTADS_UPSTREAM_HEALTH_BASEFOLDER'] = 'lst'
+    app.extensions.pop('storage_prober', None)
+    try:
+        with upstream_webdav_server():
+            prober = get_storage_prober()
+            started = time.time()
+            while prober.status()['checked_at'] is None:
+                assert time.time() - started < 10
+                time.sleep(0.01)
+
+            r = client.get(url_for('storage_status'))
+            assert r.status_code == 200
+            assert r.json['healthy']
+            assert r.json['last_success'] is not None
+            assert len(r.json['history']) == 1
+
+        prober.probe_once()
+
+        r = client.get(url_for('storage_status'))
+        assert r.status_code == 500
+        assert not r.json['healthy']
+        assert r.json['last_success'] < r.json['checked_at']
+        assert [h['healthy'] for h in r.json['history']] == [True, False]
+
+        # without periodic probes, a past result says nothing
+        prober.stop()
+        app.extensions.pop('storage_prober')
+        app.config['CTADS_STORAGE_STATUS_INTERVAL'] = 0
+        with upstream_webdav_server():
+            r = client.get(url_for('storage_status'))
+        assert r.status_code == 503
+        assert r.json['healthy'] is None
+        assert r.json['history'] == []
+    finally:
+        prober = app.extensions.pop('storage_prober', None)
+        if prober is not None:
+            prober.stop()
+        app.config.update(saved)
+
+
+@pytest.fixture
+def hanging_endpoint(app: Any):
+    # accepts connections, never answers
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+
+    config = {k: app.config[k] for k in [
+        'CTADS_UPSTREAM_ENDPOINT', 'CTADS_METADATA_READ_TIMEOUT',
+        'CTADS_CIRCUIT_BREAKER_THRESHOLD',
+        'CTADS_CIRCUIT_BREAKER_RESET_TIMEOUT']}
+    app.config['CTADS_UPSTREAM_ENDPOINT'] = \
+        'http://127.0.0.1:%s' % listener.getsockname()[1]
+    app.config['CTADS_METADATA_READ_TIMEOUT'] = 0.5
+    app.config['CTADS_CIRCUIT_BREAKER_THRESHOLD'] = 2
+    app.config['CTADS_CIRCUIT_BREAKER_RESET_TIMEOUT'] = 1
+    app.extensions.pop('upstream_pool', None)
+    app.extensions.pop('circuit_breakers', None)
+
+    yield config['CTADS_UPSTREAM_ENDPOINT']
+
+    listener.close()
+    app.config.update(config)
+    app.extensions.pop('upstream_pool', None)
+    app.extensions.pop('circuit_breakers', None)
+
+
+@pytest.mark.timeout(30)
+def test_circuit_breaker(app: Any, client: Any, hanging_endpoint):
+    for _ in range(2):
+        t0 = time.monotonic()
+        r = client.get(url_for('list_dir', path="lst"))
+        assert r.status_code == 504
+        assert time.monotonic() - t0 < 5
+
+    # fails fast without reaching the storage
+    r = client.get(url_for('list_dir', path="lst"))
+    assert r.status_code == 503
+    assert int(r.headers['Retry-After']) <= 1
+
+    r = client.get(url_for('upstream_status'))
+    storage = r.json['circuit_breakers']['storage']
+    assert storage['state'] == 'open'
+    assert storage['rejected'] == 1
+
+    app.config['CTADS_UPSTREAM_ENDPOINT'] = hanging_endpoint
+    app.extensions.pop('upstream_pool', None)
+    time.sleep(1)
+
+    with upstream_webdav_server():
+        r = client.get(url_for('list_dir', path="lst"))
+        assert r.status_code == 200
+
+    r = client.get(url_for('upstream_status'))
+    assert r.json['circuit_breakers']['storage']['state'] == 'closed'
@@ -1,6 +1,9 @@
+import os
 import pytest
 import tempfile
-from webdav4.client import Client, HTTPError, ForbiddenOperation
+from webdav4.client import (
+    Client, HTTPError, ForbiddenOperation, ResourceNotFound
+)
 from conftest import upstream_webdav_server, generate_random_file, hash_file
 
 
@@ -113,3 +116,89 @@ def test_webdav4_client_mkdir_denied(testing_download_service):
                 assert "the server does not allow creation in the namespace"\
                     in e.__str__()
                 raise e
+
+
+@pytest.mark.timeout(30)
+def test_webdav4_client_copy_move(testing_download_service):
+    with upstream_webdav_server() as (server_dir, _):
+        user_dir = f"{server_dir}/lst/users/anonymous"
+        generate_random_file(f"{user_dir}/file", 1024)
+        client = Client(testing_download_service['url'] + "/webdav/lst")
+
+        client.copy('users/anonymous/file', 'users/anonymous/copied')
+        assert hash_file(f"{user_dir}/file") == \
+            hash_file(f"{user_dir}/copied")
+
+        client.move('users/anonymous/copied',
+                    'users/anonymous/example-files/moved')
+        assert not os.path.exists(f"{user_dir}/copied")
+        assert hash_file(f"{user_dir}/file") == \
+            hash_file(f"{user_dir}/example-files/moved")
+
+        # read anywhere, write only in the user directory
+        generate_random_file(f"{server_dir}/lst/shared", 1024)
+        client.copy('shared', 'users/anonymous/shared')
+        assert os.path.exists(f"{user_dir}/shared")
+
+        for source, destination in [('shared', 'users/anonymous/moved'),
+                                    ('users/anonymous/file', 'shared-2'),
+                                    ('users/anonymous/file',
+                                     'users/anonymous/../other')]:
+            with pytest.raises((HTTPError, ForbiddenOperation)):
+                client.move(source, destination)
+        assert os.path.exists(f"{server_dir}/lst/shared")
+        assert os.path.exists(f"{user_dir}/file")
+
+
+@pytest.mark.timeout(30)
+def test_webdav4_client_delete_tree(testing_download_service):
+    with upstream_webdav_server() as (server_dir, _):
+        tree = f"{server_dir}/lst/users/anonymous/tree"
+        for d in ['a/b/c', 'a/d', 'e']:
+            os.makedirs(f"{tree}/{d}")
+            for i in range(3):
+                generate_random_file(f"{tree}/{d}/file {i}", 10)
+        client = Client(testing_download_service['url'] + "/webdav/lst")
+
+        with pytest.raises(HTTPError):
+            client.remove('tree')
+        with pytest.raises(ResourceNotFound):
+            client.remove('users/anonymous/missing')
+
+        client.remove('users/anonymous/tree/e/file 0')
+        assert not os.path.exists(f"{tree}/e/file 0")
+
+        client.remove('users/anonymous/tree')
+        assert not os.path.exists(tree)
+        assert os.path.exists(f"{server_dir}/lst/users/anonymous")
+
+
+def non_recursive_delete(wsgi_app, root):
+    """Storage refusing to DELETE non-empty directories, like dCache."""
+    def refusing_app(environ, start_response):
+        path = environ['PATH_INFO'].encode('latin-1').decode()
+        target = os.path.join(root, path.lstrip('/'))
+        if environ['REQUEST_METHOD'] == 'DELETE' and \
+                os.path.isdir(target) and os.listdir(target):
+            start_response('409 Conflict', [('Content-Length', '0')])
+            return [b'']
+        return wsgi_app(environ, start_response)
+    return refusing_app
+
+
+@pytest.mark.timeout(30)
+def test_webdav4_client_delete_tree_special_names(testing_download_service):
+    with upstream_webdav_server() as (server_dir, server):
+        httpserver = server['httpserver']
+        httpserver.wsgi_app = non_recursive_delete(
+            httpserver.wsgi_app, server_dir)
+
+        tree = f"{server_dir}/lst/users/anonymous/tree"
+        os.makedirs(f"{tree}/sub")
+        # a, c and eAf are what the special names decode to when unquoted
+        for name in ['a#b', 'c?d', 'e%41f', 'a', 'c', 'eAf']:
+            generate_random_file(f"{tree}/sub/{name}", 10)
+        client = Client(testing_download_service['url'] + "/webdav/lst")
+
+        client.remove('users/anonymous/tree')
+        assert not os.path.exists(tree)